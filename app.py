@@ -1,9 +1,18 @@
-from flask import Flask, jsonify, request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+import json
+import os
+import threading
+import time
+
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_httpauth import HTTPBasicAuth
 
 import settings
-from database import get_db
-from eloqua_client import ElqClient
+from database import get_db, close_db, encode_page_token, decode_page_token
+from eloqua_session import get_elq_client, get_governor
+from export_cache import ExportCache
 from logging_config import setup_logging
 from schema_validator import check_data_schema, activity_fields, institution_fields, person_activity_fields, \
     person_institution_fields, contact_fields
@@ -14,8 +23,15 @@ app.config.from_object("settings")
 app.logger.debug("configured Flask app")
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 auth = HTTPBasicAuth()
+app.teardown_appcontext(close_db)
 
-client = ElqClient(username=settings.ELQ_USER, password=settings.ELQ_PASSWORD, base_url=settings.ELQ_BASE_URL)
+export_executor = ThreadPoolExecutor(max_workers=settings.CONTACT_EXPORT_WORKERS)
+# export jobs queued or running in this process, their heartbeat is refreshed by a background thread
+export_jobs = set()
+export_jobs_lock = threading.Lock()
+export_heartbeat_pid = None
+contact_cache = ExportCache(ttl=settings.CONTACT_CACHE_TTL_SECONDS, max_entries=settings.CONTACT_CACHE_SIZE,
+                            directory=settings.CONTACT_CACHE_DIR or None)
 
 
 @app.route('/status', methods=["GET"])
@@ -24,6 +40,13 @@ def status():
     return "Up and running", 200
 
 
+@app.route('/status/eloqua', methods=["GET"])
+@auth.login_required()
+def eloqua_status():
+    # current use of the Eloqua call limits by this process
+    return jsonify(get_governor().utilisation()), 200
+
+
 @app.route('/activity', methods=["GET", "POST"])
 @auth.login_required()
 def activity():
@@ -46,42 +69,30 @@ def activity():
         activity_date_from = request.args.get("dateFrom", "")
         activity_date_to = request.args.get("dateTo", "")
         region = request.args.get("label", "")
-        limit = int(request.args.get("limit", 20000))
-        offset = int(request.args.get("offset", 0))
-        if limit <= 20000:
+        streaming = wants_ndjson()
+        # streaming clients get everything unless they ask for a limit
+        limit = int(request.args.get("limit", 0 if streaming else 20000))
+        offset = max(int(request.args.get("offset", 0)), 0)
+        page_token = request.args.get("next", "")
+        if 0 <= limit and (streaming or limit <= 20000):
+            after = decode_page_token(page_token) if page_token else None
+            if page_token and not after:
+                return invalid_page_token_response(page_token)
             response = db.query_all_activities_data(activity_date_from=activity_date_from,
                                                     activity_date_to=activity_date_to,
-                                                    region=region)
-            if response:
-                if offset + len(response[offset:limit + offset]) < len(response):
-                    has_more = True
-                else:
-                    has_more = False
-                formatted = {"items": response[offset:limit + offset],
-                             "totalResults": len(response),
-                             "limit": limit,
-                             "offset": offset,
-                             "count": len(response[offset:limit + offset]),
-                             "has more": has_more}
-                return jsonify(formatted), 200
-            else:
-                formatted = {"items": response,
-                             "totalResults": 0,
-                             "limit": limit,
-                             "offset": 0,
-                             "count": 0,
-                             "has more": False}
-                return jsonify(formatted), 200
+                                                    region=region,
+                                                    limit=limit if streaming else limit + 1,
+                                                    offset=offset,
+                                                    after=after)
+            if streaming:
+                return ndjson_response(response)
+            # counting scans every matching partition, so only the first page carries the total
+            total = None if after else db.count_all_activities_data(activity_date_from=activity_date_from,
+                                                                    activity_date_to=activity_date_to,
+                                                                    region=region)
+            return jsonify(format_activity_page(items=list(response), total=total, limit=limit, offset=offset)), 200
         else:
-            return jsonify({
-                "failures": [
-                    {
-                        "field": "limit",
-                        "value": "1000000",
-                        "constraint": "Must be a positive integer value, at most 1000000, if specified."
-                    }
-                ]
-            }), 400
+            return invalid_limit_response()
     else:
         return "Method not allowed", 404
 
@@ -93,42 +104,28 @@ def activity_with_contact():
     contact_date_from = request.args.get("dateFrom", "")
     contact_date_to = request.args.get("dateTo", "")
     region = request.args.get("label", "")
-    limit = int(request.args.get("limit", 20000))
-    offset = int(request.args.get("offset", 0))
-    if limit <= 20000:
+    streaming = wants_ndjson()
+    limit = int(request.args.get("limit", 0 if streaming else 20000))
+    offset = max(int(request.args.get("offset", 0)), 0)
+    page_token = request.args.get("next", "")
+    if 0 <= limit and (streaming or limit <= 20000):
+        after = decode_page_token(page_token) if page_token else None
+        if page_token and not after:
+            return invalid_page_token_response(page_token)
         response = db.query_all_activities_data_with_contact(contact_date_from=contact_date_from,
                                                              contact_date_to=contact_date_to,
-                                                             region=region)
-        if response:
-            if offset + len(response[offset:limit + offset]) < len(response):
-                has_more = True
-            else:
-                has_more = False
-            formatted = {"items": response[offset:limit + offset],
-                         "totalResults": len(response),
-                         "limit": limit,
-                         "offset": offset,
-                         "count": len(response[offset:limit + offset]),
-                         "has more": has_more}
-            return jsonify(formatted), 200
-        else:
-            formatted = {"items": response,
-                         "totalResults": 0,
-                         "limit": limit,
-                         "offset": 0,
-                         "count": 0,
-                         "has more": False}
-            return jsonify(formatted), 200
+                                                             region=region,
+                                                             limit=limit if streaming else limit + 1,
+                                                             offset=offset,
+                                                             after=after)
+        if streaming:
+            return ndjson_response(response)
+        total = None if after else db.count_all_activities_data_with_contact(contact_date_from=contact_date_from,
+                                                                             contact_date_to=contact_date_to,
+                                                                             region=region)
+        return jsonify(format_activity_page(items=list(response), total=total, limit=limit, offset=offset)), 200
     else:
-        return jsonify({
-            "failures": [
-                {
-                    "field": "limit",
-                    "value": "1000000",
-                    "constraint": "Must be a positive integer value, at most 1000000, if specified."
-                }
-            ]
-        }), 400
+        return invalid_limit_response()
 
 
 @app.route('/person/activity', methods=["POST"])
@@ -204,14 +201,27 @@ def contact():
         date_from = request.args.get("dateFrom", "")
         date_to = request.args.get("dateTo", "")
         region = request.args.get("label", "")
-        limit = int(request.args.get("limit", 5000))
-        offset = int(request.args.get("offset", 0))
+        streaming = wants_ndjson()
+        limit = int(request.args.get("limit", 0 if streaming else 5000))
+        offset = max(int(request.args.get("offset", 0)), 0)
         # label is specified
         if region:
-            if limit <= 5000:
-                response = client.export_contact(date_from=date_from,
-                                                 date_to=date_to,
-                                                 region=region)
+            cache_key = (region, date_from, date_to)
+            if streaming and limit >= 0:
+                response = contact_cache.get(cache_key)
+                if response is None:
+                    response = get_elq_client().iter_contact(date_from=date_from,
+                                                             date_to=date_to,
+                                                             region=region)
+                return ndjson_response(islice(response, offset, offset + limit if limit else None))
+            if 0 <= limit <= 5000:
+                # pages of the same query are served from one export
+                response = contact_cache.get(cache_key)
+                if response is None:
+                    response = get_elq_client().export_contact(date_from=date_from,
+                                                               date_to=date_to,
+                                                               region=region)
+                    contact_cache.set(cache_key, response)
                 if response:
                     if offset + len(response[offset:limit + offset]) < len(response):
                         has_more = True
@@ -248,6 +258,162 @@ def contact():
         return "Method not allowed", 404
 
 
+@app.route('/contact/exports', methods=["POST"])
+@auth.login_required()
+def create_contact_export():
+    body = request.get_json(force=True, silent=True)
+    # only a JSON object carries the parameters, anything else falls back to the query string
+    params = body if isinstance(body, dict) and body else request.args
+    date_from = params.get("dateFrom", "")
+    date_to = params.get("dateTo", "")
+    region = params.get("label", "")
+    if not region:
+        return "Parameter 'label' cannot be empty.", 500
+    db = get_db()
+    job_id = db.create_export_job(region=region, date_from=date_from, date_to=date_to)
+    track_export_job(job_id)
+    export_executor.submit(run_contact_export, job_id=job_id, date_from=date_from, date_to=date_to, region=region)
+    return jsonify({"id": job_id, "status": "pending", "uri": "/contact/exports/{0}".format(job_id)}), 202
+
+
+@app.route('/contact/exports/<job_id>', methods=["GET"])
+@auth.login_required()
+def get_contact_export(job_id):
+    db = get_db()
+    job = db.get_export_job(job_id, stale_after=settings.CONTACT_EXPORT_STALE_SECONDS)
+    if not job:
+        return "Contact export {0} not found.".format(job_id), 404
+    status = {"id": job["id"], "status": job["status"], "label": job["label"], "dateFrom": job["dateFrom"],
+              "dateTo": job["dateTo"], "totalResults": job["totalResults"]}
+    if job.get("error"):
+        status["error"] = job["error"]
+    if job["status"] != "success":
+        return jsonify(status), 200
+    streaming = wants_ndjson()
+    limit = int(request.args.get("limit", 0 if streaming else 5000))
+    offset = max(int(request.args.get("offset", 0)), 0)
+    if streaming and limit >= 0:
+        return ndjson_response(db.query_export_results(job_id=job_id, limit=limit, offset=offset))
+    if 0 <= limit <= 5000:
+        items = list(db.query_export_results(job_id=job_id, limit=limit, offset=offset)) if limit else []
+        status.update({"items": items,
+                       "limit": limit,
+                       "offset": offset if items else 0,
+                       "count": len(items),
+                       "has more": offset + len(items) < job["totalResults"]})
+        return jsonify(status), 200
+    return invalid_limit_response()
+
+
+def run_contact_export(job_id, date_from, date_to, region):
+    # runs on export_executor, outside of any request
+    try:
+        with app.app_context():
+            db = get_db()
+            db.update_export_job(job_id, status="running")
+            try:
+                total = 0
+                batch = []
+                for item in get_elq_client().iter_contact(date_from=date_from, date_to=date_to, region=region):
+                    batch.append(item)
+                    if len(batch) == 1000:
+                        db.insert_export_results(job_id=job_id, data=batch, start=total)
+                        total += len(batch)
+                        batch = []
+                if batch:
+                    db.insert_export_results(job_id=job_id, data=batch, start=total)
+                    total += len(batch)
+                db.update_export_job(job_id, status="success", totalResults=total, finishedAt=datetime.utcnow())
+                logger.debug("Contact export {0} complete with {1} contacts".format(job_id, total))
+            except Exception as e:
+                logger.exception("Contact export {0} failed".format(job_id))
+                db.update_export_job(job_id, status="error", error=str(e), finishedAt=datetime.utcnow())
+    finally:
+        with export_jobs_lock:
+            export_jobs.discard(job_id)
+
+
+def track_export_job(job_id):
+    # the heartbeat thread is started on first use, so a forked worker process runs its own
+    global export_heartbeat_pid
+    with export_jobs_lock:
+        if export_heartbeat_pid != os.getpid():
+            export_heartbeat_pid = os.getpid()
+            export_jobs.clear()
+            threading.Thread(target=heartbeat_export_jobs, name="export_heartbeat", daemon=True).start()
+        export_jobs.add(job_id)
+
+
+def heartbeat_export_jobs():
+    # a job stops being refreshed when this process dies, get_export_job then reports it as failed
+    while True:
+        time.sleep(max(settings.CONTACT_EXPORT_STALE_SECONDS / 3, 1))
+        with export_jobs_lock:
+            job_ids = list(export_jobs)
+        if not job_ids:
+            continue
+        try:
+            with app.app_context():
+                get_db().heartbeat_export_jobs(job_ids)
+        except Exception:
+            logger.exception("Cannot refresh the heartbeat of contact exports {0}".format(job_ids))
+
+
+def wants_ndjson():
+    if request.args.get("format", "") == "ndjson":
+        return True
+    return request.accept_mimetypes.best == "application/x-ndjson"
+
+
+def ndjson_response(items):
+    # write documents one per line as they arrive instead of building the whole page in memory
+    def generate():
+        for item in items:
+            yield json.dumps(item, default=str) + "\n"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def format_activity_page(items, total, limit, offset):
+    # one extra item is fetched to know whether another page follows
+    has_more = len(items) > limit
+    items = items[:limit]
+    formatted = {"items": items}
+    # keyset pages (next token) leave the total out, the first page already returned it
+    if total is not None:
+        formatted["totalResults"] = total
+    formatted.update({"limit": limit,
+                      "offset": offset if items else 0,
+                      "count": len(items),
+                      "has more": has_more})
+    if has_more and items:
+        formatted["next"] = encode_page_token(items[-1])
+    return formatted
+
+
+def invalid_limit_response():
+    return jsonify({
+        "failures": [
+            {
+                "field": "limit",
+                "value": "1000000",
+                "constraint": "Must be a positive integer value, at most 1000000, if specified."
+            }
+        ]
+    }), 400
+
+
+def invalid_page_token_response(page_token):
+    return jsonify({
+        "failures": [
+            {
+                "field": "next",
+                "value": page_token,
+                "constraint": "Must be a page token returned by a previous request, if specified."
+            }
+        ]
+    }), 400
+
+
 @auth.verify_password
 def verify(username, password):
     if username == settings.DB_USER and password == settings.DB_PASSWORD:
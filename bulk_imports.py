@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import requests
+
+from export_definitions import bulk_api_path, run_sync
+from logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+# seconds before the first retry of a failed batch, doubled on every further attempt
+batch_retry_delay = 2
+
+
+class BulkImporter:
+    # uploads a dataset into one Eloqua import definition in batches, several at once,
+    # and syncs the staged data once at the end or every sync_every batches
+    def __init__(self, session, base_url, batch_size=5000, max_workers=1, sync_every=0, batch_retries=3):
+        self._session = session
+        self._bulk_url = base_url.rstrip("/") + bulk_api_path
+        self.batch_size = max(batch_size, 1)
+        self.max_workers = max(max_workers, 1)
+        self.sync_every = sync_every
+        self.batch_retries = batch_retries
+
+    def import_contacts(self, data, name, fields, id_field_name):
+        body = {"name": name,
+                "fields": {field: str(statement) for field, statement in fields.items()},
+                "identifierFieldName": id_field_name,
+                "isSyncTriggeredOnImport": False}
+        return self._import(path="/contacts/imports", body=body, data=data)
+
+    def import_cdo(self, data, cdo_id, name, fields, id_field_name, map_data_cards=None):
+        body = {"name": name,
+                "fields": {field: str(statement) for field, statement in fields.items()},
+                "identifierFieldName": id_field_name,
+                "isSyncTriggeredOnImport": False}
+        if map_data_cards:
+            # e.g. {"entity_type": "Contact", "entity_field": "{{Contact.Field(...)}}", "source_field": "..."}
+            body.update({"mapDataCards": True,
+                         "mapDataCardsEntityType": map_data_cards["entity_type"],
+                         "mapDataCardsEntityField": str(map_data_cards["entity_field"]),
+                         "mapDataCardsSourceField": map_data_cards["source_field"],
+                         "mapDataCardsCaseSensitiveMatch": False})
+        return self._import(path="/customObjects/{0}/imports".format(cdo_id), body=body, data=data)
+
+    def _import(self, path, body, data):
+        batches = [data[start:start + self.batch_size] for start in range(0, len(data), self.batch_size)]
+        if not batches:
+            return 0
+        response = self._session.post(self._bulk_url + path, json=body)
+        response.raise_for_status()
+        uri = response.json()["uri"]
+        logger.debug("Created import definition {0} ({1}) for {2} batches".format(uri, body["name"], len(batches)))
+        try:
+            rounds = [batches]
+            if self.sync_every:
+                rounds = [batches[start:start + self.sync_every] for start in range(0, len(batches), self.sync_every)]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for batches_to_sync in rounds:
+                    # all batches of a round are staged before the round is synced
+                    list(executor.map(lambda batch: self._upload_batch(uri=uri, batch=batch), batches_to_sync))
+                    sync_uri = run_sync(session=self._session, bulk_url=self._bulk_url, uri=uri)
+                    logger.debug("Synced {0} batches of import {1} ({2})".format(len(batches_to_sync), uri, sync_uri))
+        finally:
+            self._delete(uri=uri)
+        return len(data)
+
+    def _upload_batch(self, uri, batch):
+        # a failed batch is retried on its own, the batches already staged are kept. the session only resends
+        # a POST on 429, so this is the one retry layer for dropped connections and 5xx; other 4xx are final
+        attempt = 0
+        while True:
+            try:
+                response = self._session.post("{0}{1}/data".format(self._bulk_url, uri), json=batch)
+                response.raise_for_status()
+                return len(batch)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                server_error = e.response is not None and e.response.status_code >= 500
+                if attempt >= self.batch_retries or (isinstance(e, requests.HTTPError) and not server_error):
+                    raise
+                delay = batch_retry_delay * 2 ** attempt
+                attempt += 1
+                logger.warning("Upload of {0} items to {1} failed, retry {2} in {3}s: {4}".format(
+                    len(batch), uri, attempt, delay, e))
+                time.sleep(delay)
+
+    def _delete(self, uri):
+        try:
+            self._session.delete(self._bulk_url + uri).raise_for_status()
+        except requests.RequestException as e:
+            logger.debug("Cannot delete import definition {0}: {1}".format(uri, e))
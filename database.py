@@ -1,22 +1,208 @@
 from flask import g, current_app
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import ConnectionFailure
 
 from logging_config import setup_logging
 
 from datetime import datetime, timedelta
+import atexit
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import threading
 
 logger = setup_logging(__name__)
 
+# stable sort order of allActivities, also used as the keyset for page tokens
+activity_sort = [("ActivityDate", ASCENDING), ("ActivityId", ASCENDING)]
+
+# indexes created by Database.ensure_indexes (migrate_db.py), as (keys, options) per collection
+indexes = {
+    "allActivities": [
+        (activity_sort, {}),
+        ([("region", ASCENDING), ("ActivityDate", ASCENDING), ("ActivityId", ASCENDING)], {}),
+        ([("C_DateModified", ASCENDING)], {}),
+        ([("region", ASCENDING), ("C_DateModified", ASCENDING)], {}),
+        # one document per activity, duplicates are resolved by upsert_activities
+        ([("ActivityType", ASCENDING), ("ActivityId", ASCENDING)], {"unique": True}),
+    ],
+    "activity": [([("region", ASCENDING)], {})],
+    # personActivity and personInstitution are also the $lookup targets of get_cdo_data
+    "personActivity": [([("region", ASCENDING)], {}), ([("IM_CRM_Meeting_ID", ASCENDING)], {})],
+    "institution": [([("region", ASCENDING)], {})],
+    "personInstitution": [([("region", ASCENDING)], {}), ([("IM_CRM_Institution_ID", ASCENDING)], {})],
+    "contact": [([("region", ASCENDING)], {})],
+    # region + content_hash lets get_past_hashes run as a covered query
+    # region + record key is the upsert filter of move_data_past
+    "activityPast": [([("region", ASCENDING), ("content_hash", ASCENDING)], {}),
+                     ([("region", ASCENDING), ("IM_CRM_Row_ID", ASCENDING)], {})],
+    "institutionPast": [([("region", ASCENDING), ("content_hash", ASCENDING)], {}),
+                        ([("region", ASCENDING), ("IM_CRM_Row_ID", ASCENDING)], {})],
+    # region + C_EmailAddress finds the archived version of a contact for field-level deltas
+    "contactPast": [([("region", ASCENDING), ("content_hash", ASCENDING)], {}),
+                    ([("region", ASCENDING), ("C_EmailAddress", ASCENDING)], {})],
+    # contact export jobs and their rows are dropped a day after the job was created
+    "contactExportJobs": [([("createdAt", ASCENDING)], {"expireAfterSeconds": 86400})],
+    "contactExportResults": [([("job_id", ASCENDING), ("seq", ASCENDING)], {}),
+                             ([("createdAt", ASCENDING)], {"expireAfterSeconds": 86400})],
+}
+
+# contact export job statuses that still wait for their worker
+unfinished_export_status = ["pending", "running"]
+
+# region codes handled by the importer
+regions = ["ES", "PT", "UK", "DE"]
+# a region code standing as its own token, e.g. "ES-123" or "MESSAGE-UK-1" but not the "ES" inside "MESSAGE"
+region_pattern = re.compile(r"(?<![A-Za-z])({0})(?![A-Za-z])".format("|".join(regions)))
+
+# source field of the materialised "region" field of each collection
+region_fields = {
+    "contact": "C_IM_CRM_Security_Label1",
+    "activity": "Meeting_ID",
+    "institution": "IM_CRM_Institution_ID",
+    "personActivity": "IM_CRM_Meeting_ID",
+    "personInstitution": "IM_CRM_Institution_ID",
+    "allActivities": "C_IM_CRM_Contact_ID1",
+    "contactPast": "C_IM_CRM_Security_Label1",
+    "activityPast": "Meeting_ID",
+    "institutionPast": "IM_CRM_Institution_ID",
+}
+
+# allActivities is stored in one collection per month of ActivityDate, "allActivities_YYYYMM";
+# activities without a date go to the undated partition, which sorts first like null dates do
+activity_partition_prefix = "allActivities_"
+undated_activity_partition = "allActivities_undated"
+activity_partition_pattern = re.compile(r"^allActivities_(\d{6}|undated)$")
+activity_month_pattern = re.compile(r"^(\d{4})-(\d{2})")
+
+# record key of each archive, archived documents are upserted by region + key
+archive_keys = {
+    "contactPast": "C_EmailAddress",
+    "activityPast": "IM_CRM_Row_ID",
+    "institutionPast": "IM_CRM_Row_ID",
+}
+# current collections emptied once a region is archived
+archive_sources = {
+    "contactPast": ["contact"],
+    "activityPast": ["activity", "personActivity"],
+    "institutionPast": ["institution", "personInstitution"],
+}
+
+_client = None
+_client_pid = None
+# activity partitions whose indexes were ensured by this process
+_indexed_partitions = set()
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            # a client inherited through fork() must not be reused, the child builds its own pool
+            if _client is None or _client_pid != pid:
+                _client = MongoClient(current_app.config["MONGO_URI"],
+                                      maxPoolSize=current_app.config["MONGO_MAX_POOL_SIZE"],
+                                      waitQueueTimeoutMS=current_app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+                                      serverSelectionTimeoutMS=current_app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"])
+                _client_pid = pid
+                logger.debug("Created MongoDB client for process {0}".format(pid))
+    return _client
+
+
+def close_client():
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+atexit.register(close_client)
+
 
 def get_db():
     if "db" not in g:
-        g.db = Database()
+        g.db = Database(client=get_client())
     return g.db
 
 
+def close_db(exception=None):
+    # the pooled client outlives the request, only the per-context handle is dropped
+    g.pop("db", None)
+
+
+# bookkeeping fields that are not part of a record's content
+unhashed_fields = ("_id", "region", "content_hash")
+
+
+def content_hash(record):
+    # canonical field order, so the same content always gives the same hash
+    content = {key: value for key, value in record.items() if key not in unhashed_fields}
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def derive_region(value):
+    match = region_pattern.search(value or "")
+    if match:
+        return match.group(1)
+    return None
+
+
+def activity_month(activity_date):
+    # "2021-03-04 10:00:00" -> "202103"
+    if isinstance(activity_date, str):
+        match = activity_month_pattern.match(activity_date)
+        if match:
+            return match.group(1) + match.group(2)
+    return None
+
+
+def activity_partition(activity_date):
+    month = activity_month(activity_date)
+    if month:
+        return activity_partition_prefix + month
+    return undated_activity_partition
+
+
+def build_activity_query(date_field=None, date_from="", date_to="", region=""):
+    # only equality and range predicates so the planner can use the indexes above
+    query = {}
+    date_range = {}
+    if date_from:
+        date_range["$gt"] = date_from
+    if date_to:
+        date_range["$lt"] = date_to
+    if date_field and date_range:
+        query[date_field] = date_range
+    if region:
+        query["region"] = region
+    return query
+
+
+def encode_page_token(activity):
+    key = json.dumps([activity.get("ActivityDate"), activity.get("ActivityId")])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_page_token(token):
+    try:
+        activity_date, activity_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        return None
+    return activity_date, activity_id
+
+
 class Database:
-    def __init__(self):
-        self._client = MongoClient()
+    def __init__(self, client):
+        self._client = client
         self._database = self._client[current_app.config["CLOUD_APP_DB_NAME"]]
         # current collections
         self._contact = self._database["contact"]
@@ -28,15 +214,74 @@ class Database:
         self._contactPast = self._database["contactPast"]
         self._activityPast = self._database["activityPast"]
         self._institutionPast = self._database["institutionPast"]
-        # all activities collection
+        # unpartitioned all activities collection, emptied by partition_activities
         self._allActivities = self._database["allActivities"]
-        # joined collections
-        self._joinedActivity = self._database["joinedActivity"]
-        self._joinedInstitution = self._database["joinedInstitution"]
+        # sync state collection
+        self._syncState = self._database["syncState"]
+        # contact export job collections
+        self._contactExportJobs = self._database["contactExportJobs"]
+        self._contactExportResults = self._database["contactExportResults"]
+
+    def ensure_indexes(self):
+        for collection, collection_indexes in indexes.items():
+            for keys, options in collection_indexes:
+                self._create_index(collection=collection, keys=keys, options=options)
+        # every activity partition gets the allActivities indexes
+        for partition in self._activity_partitions():
+            self._ensure_partition_indexes(partition=partition.name)
+        logger.debug("Indexes ensured for {0} collections".format(len(indexes)))
+
+    def _ensure_partition_indexes(self, partition):
+        for keys, options in indexes["allActivities"]:
+            self._create_index(collection=partition, keys=keys, options=options)
+        _indexed_partitions.add(partition)
+
+    def _create_index(self, collection, keys, options):
+        try:
+            self._database[collection].create_index(keys, background=True, **options)
+        except ConnectionFailure:
+            # every other index would wait for the server selection timeout again
+            raise
+        except Exception as e:
+            message = "Cannot create index {0} on collection {1}: {2}".format(keys, collection, e)
+            if options.get("unique"):
+                # without it every activity sync can store duplicates again
+                logger.error(message + ", run migrate_db.py --deduplicate_activities 1 to delete the duplicates "
+                                       "and build it")
+            else:
+                logger.warning(message)
+
+    def backfill_region(self, batch_size=1000, recompute=False):
+        # recompute=True derives the region of every document again and rewrites the ones that changed
+        for collection_name, field in region_fields.items():
+            collections = [self._database[collection_name]]
+            if collection_name == "allActivities":
+                collections += self._activity_partitions()
+            for collection in collections:
+                updates = []
+                updated = 0
+                query = {} if recompute else {"region": {"$exists": False}}
+                for item in collection.find(query, {field: 1, "region": 1}):
+                    region = derive_region(item.get(field))
+                    if "region" in item and item["region"] == region:
+                        continue
+                    updates.append(UpdateOne({"_id": item["_id"]}, {"$set": {"region": region}}))
+                    if len(updates) == batch_size:
+                        updated += collection.bulk_write(updates, ordered=False).modified_count
+                        updates = []
+                if updates:
+                    updated += collection.bulk_write(updates, ordered=False).modified_count
+                logger.debug("Region backfilled for {0} documents in collection {1}".format(updated, collection.name))
 
     def insert_data(self, collection, data):
         try:
             if data:
+                if collection in region_fields:
+                    for item in data:
+                        item["region"] = derive_region(item.get(region_fields[collection]))
+                if collection in ("contactPast", "activityPast", "institutionPast"):
+                    for item in data:
+                        item["content_hash"] = content_hash(item)
                 # current collections
                 if collection == "activity":
                     self._activity.insert_many(data)
@@ -55,15 +300,9 @@ class Database:
                     logger.debug("{0} Person Institution inserted to DB".format(len(data)))
                 # all activities collection
                 if collection == "allActivities":
-                    self._allActivities.insert_many(data)
+                    for partition, activities in self._partition_activities(data).items():
+                        self._database[partition].insert_many(activities)
                     logger.debug("{0} Activity inserted to DB".format(len(data)))
-                # joined collections
-                if collection == "joinedActivity":
-                    self._joinedActivity.insert_many(data)
-                    logger.debug("{0} Joined Activity CDO inserted to DB".format(len(data)))
-                if collection == "joinedInstitution":
-                    self._joinedInstitution.insert_many(data)
-                    logger.debug("{0} Joined Institution CDO inserted to DB".format(len(data)))
                 # past collections
                 if collection == "contactPast":
                     self._contactPast.insert_many(data)
@@ -82,239 +321,357 @@ class Database:
             logger.debug("Cannot insert data to collection {0} in DB".format(collection))
             return False
 
+    def upsert_activities(self, data, batch_size):
+        inserted = 0
+        updated = 0
+        # an activity keeps its ActivityDate, so it is always upserted into the same monthly partition
+        for partition, activities in self._partition_activities(data).items():
+            collection = self._database[partition]
+            requests = []
+            for item in activities:
+                item["region"] = derive_region(item.get(region_fields["allActivities"]))
+                key = {"ActivityType": item.get("ActivityType"), "ActivityId": item.get("ActivityId")}
+                requests.append(UpdateOne(key, {"$set": item}, upsert=True))
+                if len(requests) == batch_size:
+                    result = collection.bulk_write(requests, ordered=False)
+                    inserted += result.upserted_count
+                    updated += result.modified_count
+                    requests = []
+            if requests:
+                result = collection.bulk_write(requests, ordered=False)
+                inserted += result.upserted_count
+                updated += result.modified_count
+        logger.debug("{0} Activity inserted and {1} updated in DB".format(inserted, updated))
+        return inserted, updated
+
+    def _partition_activities(self, data):
+        partitions = {}
+        for item in data:
+            partitions.setdefault(activity_partition(item.get("ActivityDate")), []).append(item)
+        # new partitions get their indexes before the first write
+        for partition in partitions:
+            if partition not in _indexed_partitions:
+                self._ensure_partition_indexes(partition=partition)
+        return partitions
+
+    def _activity_partitions(self, date_from="", date_to=""):
+        # activity partitions in ActivityDate order, only the months overlapping date_from/date_to when given
+        lower = activity_month(date_from)
+        upper = activity_month(date_to)
+        names = sorted(name for name in self._database.list_collection_names()
+                       if activity_partition_pattern.match(name))
+        partitions = []
+        for name in names:
+            if name == undated_activity_partition:
+                # a date range never matches activities without a date
+                if not date_from and not date_to:
+                    partitions.insert(0, name)
+                continue
+            month = name[len(activity_partition_prefix):]
+            if (lower and month < lower) or (upper and month > upper):
+                continue
+            partitions.append(name)
+        return [self._database[name] for name in partitions]
+
+    def partition_activities(self, batch_size=1000):
+        # one-off: move activities of the unpartitioned allActivities collection into the monthly partitions
+        moved = 0
+        while True:
+            batch = list(self._allActivities.find({}).limit(batch_size))
+            if not batch:
+                break
+            ids = [item.pop("_id") for item in batch]
+            self.upsert_activities(data=batch, batch_size=batch_size)
+            moved += self._allActivities.delete_many({"_id": {"$in": ids}}).deleted_count
+        logger.debug("{0} Activity moved to monthly partitions".format(moved))
+
+    def apply_activity_retention(self, months):
+        # drop whole monthly partitions older than the retention, months=0 keeps everything
+        if not months:
+            return []
+        today = datetime.utcnow()
+        year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+        cutoff = activity_partition_prefix + "{0:04d}{1:02d}".format(year, month + 1)
+        dropped = []
+        for partition in self._activity_partitions():
+            if partition.name != undated_activity_partition and partition.name < cutoff:
+                partition.drop()
+                _indexed_partitions.discard(partition.name)
+                dropped.append(partition.name)
+        logger.debug("Activity partitions dropped by retention of {0} months: {1}".format(months, dropped))
+        return dropped
+
+    def deduplicate_activities(self):
+        # keep the first document of each (ActivityType, ActivityId) so the unique index can be built,
+        # in allActivities and in every monthly partition
+        pipeline = [{"$group": {"_id": {"ActivityType": "$ActivityType", "ActivityId": "$ActivityId"},
+                                "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+                    {"$match": {"count": {"$gt": 1}}}]
+        deleted = 0
+        for collection in [self._allActivities] + self._activity_partitions():
+            for duplicate in collection.aggregate(pipeline=pipeline, allowDiskUse=True):
+                deleted += collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}}).deleted_count
+        logger.debug("{0} duplicated Activity deleted from DB".format(deleted))
+
     def get_cdo_data(self, collection, region):
+        # left join with the person collection, reshape and deduplicate in one pipeline,
+        # matching the region first so the join only touches the region's rows
         if collection == "activity":
-            # perform left outer join
-            # without-merge join
-            pipeline = [{"$lookup": {"from": "personActivity", "localField": "Meeting_ID",
-                                     "foreignField": "IM_CRM_Meeting_ID", "as": "activityDetail"}},
-                        {"$match": {"Meeting_ID": {"$regex": region}}},
-                        {"$unwind": {"path": "$activityDetail", "preserveNullAndEmptyArrays": False}}]
-            joined_activity = list(self._activity.aggregate(pipeline=pipeline))
-            if joined_activity:
-                # perform some transformation on join results
-                for i in joined_activity:
-                    contact_id = i["activityDetail"]["IM_CRM_Contact_ID"]
-                    row_id = i["activityDetail"]["IM_CRM_Row_ID"]
-                    i["IM_CRM_Contact_ID"] = contact_id
-                    i["IM_CRM_Row_ID"] = row_id
-                    i.pop("activityDetail", None)
-                    i.pop("_id", None)
-                # insert joined data to joined collections as temporary staging areas
-                self.insert_data(collection="joinedActivity", data=joined_activity)
-                # return joined data from joined collection
-                # (failed if directly return the joined data from above)
-                activities = list(self._joinedActivity.find({}, {"_id": 0}))
-                # filter for unique activities
-                return list(map(dict, set(tuple(activity.items()) for activity in activities)))
-            else:
-                logger.debug("No joined Activity CDO for country {0}".format(region.pattern))
-                return None
+            pipeline = self._joined_cdo_pipeline(region=region, person_collection="personActivity",
+                                                 local_field="Meeting_ID", foreign_field="IM_CRM_Meeting_ID")
+            return self._activity.aggregate(pipeline=pipeline, allowDiskUse=True)
         if collection == "institution":
-            pipeline = [{"$lookup": {"from": "personInstitution", "localField": "IM_CRM_Institution_ID",
-                                     "foreignField": "IM_CRM_Institution_ID", "as": "institutionDetail"}},
-                        {"$match": {"IM_CRM_Institution_ID": {"$regex": region}}},
-                        {"$unwind": {"path": "$institutionDetail", "preserveNullAndEmptyArrays": False}}]
-            joined_institution = list(self._institution.aggregate(pipeline=pipeline))
-            if joined_institution:
-                for i in joined_institution:
-                    contact_id = i["institutionDetail"]["IM_CRM_Contact_ID"]
-                    row_id = i["institutionDetail"]["IM_CRM_Row_ID"]
-                    i["IM_CRM_Contact_ID"] = contact_id
-                    i["IM_CRM_Row_ID"] = row_id
-                    i.pop("institutionDetail", None)
-                    i.pop("_id", None)
-                self.insert_data(collection="joinedInstitution", data=joined_institution)
-                institutions = list(self._joinedInstitution.find({}, {"_id": 0}))
-                return list(map(dict, set(tuple(institution.items()) for institution in institutions)))
-            logger.debug("No joined Institution CDO for country {0}".format(region.pattern))
-            return None
+            pipeline = self._joined_cdo_pipeline(region=region, person_collection="personInstitution",
+                                                 local_field="IM_CRM_Institution_ID",
+                                                 foreign_field="IM_CRM_Institution_ID")
+            return self._institution.aggregate(pipeline=pipeline, allowDiskUse=True)
+
+    def _joined_cdo_pipeline(self, region, person_collection, local_field, foreign_field):
+        return [{"$match": {"region": region}},
+                {"$lookup": {"from": person_collection, "localField": local_field,
+                             "foreignField": foreign_field, "as": "personDetail"}},
+                {"$unwind": {"path": "$personDetail", "preserveNullAndEmptyArrays": False}},
+                {"$addFields": {"IM_CRM_Contact_ID": "$personDetail.IM_CRM_Contact_ID",
+                                "IM_CRM_Row_ID": "$personDetail.IM_CRM_Row_ID"}},
+                {"$project": {"_id": 0, "region": 0, "personDetail": 0}},
+                # filter for unique records
+                {"$group": {"_id": "$$ROOT"}},
+                {"$replaceRoot": {"newRoot": "$_id"}}]
 
     def get_contact_data(self, region):
-        contacts = list(self._contact.find({"C_IM_CRM_Security_Label1": {"$regex": region}}, {"_id": 0}))
+        contacts = list(self._contact.find({"region": region}, {"_id": 0, "region": 0}))
         if contacts:
             # filter for unique contacts
             return list(map(dict, set(tuple(contact.items()) for contact in contacts)))
         return None
 
-    def get_all_activities_data(self, type=None):
-        if type == "PageView":
-            return list(self._allActivities.find({"ActivityType": "PageView"}, {"_id": 0}))
-        return list(self._allActivities.find({"ActivityType": {"$ne": "PageView"}}, {"_id": 0}))
-
-    def get_past_data(self, collection, region):
-        if collection == "activityPast":
-            return list(self._activityPast.find({"Meeting_ID": {"$regex": region}}, {"_id": 0}))
-        if collection == "institutionPast":
-            return list(self._institutionPast.find({"IM_CRM_Institution_ID": {"$regex": region}}, {"_id": 0}))
-        if collection == "contactPast":
-            return list(self._contactPast.find({"C_IM_CRM_Security_Label1": {"$regex": region}}, {"_id": 0}))
-
-    def query_all_activities_data(self, activity_date_from, activity_date_to, region):
-        if len(self.get_all_activities_data()) != 0:
-            if region:
-                if activity_date_from and activity_date_to:
-                    return list(self._allActivities.find({"$and": [{"ActivityDate": {"$gt": activity_date_from,
-                                                                                     "$lt": activity_date_to}},
-                                                                   {"C_IM_CRM_Contact_ID1": {"$regex": region}}]},
-                                                         {"_id": 0}))
-                elif activity_date_from:
-                    return list(self._allActivities.find({"$and": [{"ActivityDate": {"$gt": activity_date_from}},
-                                                                   {"C_IM_CRM_Contact_ID1": {"$regex": region}}]},
-                                                         {"_id": 0}))
-                elif activity_date_to:
-                    return list(self._allActivities.find({"$and": [{"ActivityDate": {"$lt": activity_date_to}},
-                                                                   {"C_IM_CRM_Contact_ID1": {"$regex": region}}]},
-                                                         {"_id": 0}))
-                else:
-                    return list(self._allActivities.find({"C_IM_CRM_Contact_ID1": {"$regex": region}},
-                                                         {"_id": 0}))
-            else:
-                if activity_date_from and activity_date_to:
-                    return list(self._allActivities.find({"ActivityDate": {"$gt": activity_date_from,
-                                                                           "$lt": activity_date_to}},
-                                                         {"_id": 0}))
-                elif activity_date_from:
-                    return list(self._allActivities.find({"ActivityDate": {"$gt": activity_date_from}},
-                                                         {"_id": 0}))
-                elif activity_date_to:
-                    return list(self._allActivities.find({"ActivityDate": {"$lt": activity_date_to}},
-                                                         {"_id": 0}))
-                else:
-                    return self.get_all_activities_data()
-        else:
-            logger.debug("No Activity existed")
-            return list()
-
-    def query_all_activities_data_with_contact(self, contact_date_from, contact_date_to, region):
-        if len(self.get_all_activities_data()) != 0:
-            if region:
-                if contact_date_from and contact_date_to:
-                    return list(self._allActivities.find({"$and": [{"C_DateModified": {"$gt": contact_date_from,
-                                                                                       "$lt": contact_date_to}},
-                                                                   {"C_IM_CRM_Contact_ID1": {"$regex": region}}]},
-                                                         {"_id": 0}))
-                elif contact_date_from:
-                    return list(self._allActivities.find({"$and": [{"C_DateModified": {"$gt": contact_date_from}},
-                                                                   {"C_IM_CRM_Contact_ID1": {"$regex": region}}]},
-                                                         {"_id": 0}))
-                elif contact_date_to:
-                    return list(self._allActivities.find({"$and": [{"C_DateModified": {"$lt": contact_date_to}},
-                                                                   {"C_IM_CRM_Contact_ID1": {"$regex": region}}]},
-                                                         {"_id": 0}))
-                else:
-                    current_time = datetime.utcnow()
-                    past_time = datetime.utcnow() - timedelta(days=1)
-                    contact_date_from_default = str(past_time.date()) + " " + str(past_time.time())
-                    contact_date_to_default = str(current_time.date()) + " " + str(current_time.time())
-                    return list(self._allActivities.find({"$and": [{"C_DateModified": {"$gt": contact_date_from_default,
-                                                                                       "$lt": contact_date_to_default}},
-                                                                   {"C_IM_CRM_Contact_ID1": {"$regex": region}}]},
-                                                         {"_id": 0}))
+    def create_export_job(self, region, date_from, date_to):
+        now = datetime.utcnow()
+        job = {"label": region, "dateFrom": date_from, "dateTo": date_to, "status": "pending",
+               "totalResults": 0, "createdAt": now, "heartbeatAt": now}
+        return str(self._contactExportJobs.insert_one(job).inserted_id)
+
+    def update_export_job(self, job_id, **fields):
+        self._contactExportJobs.update_one({"_id": ObjectId(job_id)}, {"$set": fields})
+
+    def heartbeat_export_jobs(self, job_ids):
+        self._contactExportJobs.update_many({"_id": {"$in": [ObjectId(job_id) for job_id in job_ids]},
+                                             "status": {"$in": unfinished_export_status}},
+                                            {"$set": {"heartbeatAt": datetime.utcnow()}})
+
+    def get_export_job(self, job_id, stale_after=0):
+        if not ObjectId.is_valid(job_id):
+            return None
+        if stale_after:
+            # the worker owning an unfinished job refreshes heartbeatAt, a job it stopped refreshing
+            # will never finish, e.g. the process was restarted while the job was queued or running
+            now = datetime.utcnow()
+            self._contactExportJobs.update_one(
+                {"_id": ObjectId(job_id), "status": {"$in": unfinished_export_status},
+                 "heartbeatAt": {"$not": {"$gte": now - timedelta(seconds=stale_after)}}},
+                {"$set": {"status": "error", "error": "Export worker stopped before the job finished.",
+                          "finishedAt": now}})
+        job = self._contactExportJobs.find_one({"_id": ObjectId(job_id)})
+        if job:
+            job["id"] = str(job.pop("_id"))
+        return job
+
+    def insert_export_results(self, job_id, data, start):
+        created_at = datetime.utcnow()
+        self._contactExportResults.insert_many([{"job_id": job_id, "seq": start + index, "createdAt": created_at,
+                                                 "item": item} for index, item in enumerate(data)])
+
+    def query_export_results(self, job_id, limit=0, offset=0):
+        cursor = self._contactExportResults.find({"job_id": job_id, "seq": {"$gte": offset}},
+                                                 {"_id": 0, "item": 1}).sort("seq", ASCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return (result["item"] for result in cursor)
+
+    def get_sync_watermarks(self):
+        return {item["_id"]: item["watermark"] for item in self._syncState.find({"watermark": {"$exists": True}})}
+
+    def set_sync_watermark(self, name, watermark):
+        # watermarks are "YYYY-MM-DD HH:MM:SS" strings, $max keeps them from moving backwards
+        self._syncState.update_one({"_id": name}, {"$max": {"watermark": watermark}}, upsert=True)
+        logger.debug("Sync watermark of {0} set to {1}".format(name, watermark))
+
+    def get_past_contacts(self, region, emails):
+        # archived version of each contact, keyed by email address
+        past_contacts = {}
+        emails = list(emails)
+        for start in range(0, len(emails), 1000):
+            query = {"region": region, "C_EmailAddress": {"$in": emails[start:start + 1000]}}
+            for contact in self._contactPast.find(query, {"_id": 0, "region": 0, "content_hash": 0}):
+                past_contacts[contact["C_EmailAddress"]] = contact
+        return past_contacts
+
+    def get_past_hashes(self, collection, region):
+        past = self._database[collection]
+        hashes = set(item["content_hash"] for item in
+                     past.find({"region": region, "content_hash": {"$exists": True}}, {"_id": 0, "content_hash": 1}))
+        # documents archived before hashes were stored are hashed on the fly
+        for item in past.find({"region": region, "content_hash": {"$exists": False}}):
+            hashes.add(content_hash(item))
+        return hashes
+
+    def query_all_activities_data(self, activity_date_from, activity_date_to, region, limit=0, offset=0, after=None):
+        query = self._activities_date_query(activity_date_from=activity_date_from,
+                                            activity_date_to=activity_date_to,
+                                            region=region)
+        return self._find_activities_page(query=query, limit=limit, offset=offset, after=after,
+                                          date_from=activity_date_from, date_to=activity_date_to)
+
+    def count_all_activities_data(self, activity_date_from, activity_date_to, region):
+        query = self._activities_date_query(activity_date_from=activity_date_from,
+                                            activity_date_to=activity_date_to,
+                                            region=region)
+        return self._count_activities(query=query, date_from=activity_date_from, date_to=activity_date_to)
+
+    def query_all_activities_data_with_contact(self, contact_date_from, contact_date_to, region,
+                                               limit=0, offset=0, after=None):
+        query = self._activities_contact_date_query(contact_date_from=contact_date_from,
+                                                    contact_date_to=contact_date_to,
+                                                    region=region)
+        return self._find_activities_page(query=query, limit=limit, offset=offset, after=after)
+
+    def count_all_activities_data_with_contact(self, contact_date_from, contact_date_to, region):
+        query = self._activities_contact_date_query(contact_date_from=contact_date_from,
+                                                    contact_date_to=contact_date_to,
+                                                    region=region)
+        return self._count_activities(query=query)
+
+    def _activities_date_query(self, activity_date_from, activity_date_to, region):
+        query = build_activity_query(date_field="ActivityDate",
+                                     date_from=activity_date_from,
+                                     date_to=activity_date_to,
+                                     region=region)
+        if not query:
+            # without any filter only non-PageView activities are listed
+            query["ActivityType"] = {"$ne": "PageView"}
+        return query
+
+    def _activities_contact_date_query(self, contact_date_from, contact_date_to, region):
+        if not contact_date_from and not contact_date_to:
+            # default to contacts modified in the last 24 hours
+            current_time = datetime.utcnow()
+            past_time = current_time - timedelta(days=1)
+            contact_date_from = str(past_time.date()) + " " + str(past_time.time())
+            contact_date_to = str(current_time.date()) + " " + str(current_time.time())
+        return build_activity_query(date_field="C_DateModified",
+                                    date_from=contact_date_from,
+                                    date_to=contact_date_to,
+                                    region=region)
+
+    def _find_activities_page(self, query, limit, offset, after, date_from="", date_to=""):
+        # keyset pagination on (ActivityDate, ActivityId) when a page token is given, skip/limit otherwise;
+        # only the partitions overlapping the ActivityDate range are read, C_DateModified queries read all of them
+        if after:
+            activity_date, activity_id = after
+            if activity_date is None:
+                # activities without a date sort first, everything with a date comes after them
+                keyset = {"$or": [{"ActivityDate": None, "ActivityId": {"$gt": activity_id}},
+                                  {"ActivityDate": {"$ne": None}}]}
             else:
-                if contact_date_from and contact_date_to:
-                    return list(self._allActivities.find({"C_DateModified": {"$gt": contact_date_from,
-                                                                             "$lt": contact_date_to}},
-                                                         {"_id": 0}))
-                elif contact_date_from:
-                    return list(self._allActivities.find({"C_DateModified": {"$gt": contact_date_from}},
-                                                         {"_id": 0}))
-                elif contact_date_to:
-                    return list(self._allActivities.find({"C_DateModified": {"$lt": contact_date_to}},
-                                                         {"_id": 0}))
-                else:
-                    current_time = datetime.utcnow()
-                    past_time = datetime.utcnow() - timedelta(days=1)
-                    contact_date_from_default = str(past_time.date()) + " " + str(past_time.time())
-                    contact_date_to_default = str(current_time.date()) + " " + str(current_time.time())
-                    return list(self._allActivities.find({"C_DateModified": {"$gt": contact_date_from_default,
-                                                                             "$lt": contact_date_to_default}},
-                                                         {"_id": 0}))
-        else:
-            logger.debug("No Activity existed")
-            return list()
+                keyset = {"$or": [{"ActivityDate": {"$gt": activity_date}},
+                                  {"ActivityDate": activity_date, "ActivityId": {"$gt": activity_id}}]}
+            query = {"$and": [query, keyset]}
+            if activity_month(activity_date) and (not date_from or activity_date > date_from):
+                date_from = activity_date
+        partitions = self._activity_partitions(date_from=date_from, date_to=date_to)
+        return self._iter_partitions(partitions=partitions, query=query, limit=limit,
+                                     offset=0 if after else offset)
+
+    def _iter_partitions(self, partitions, query, limit, offset):
+        # partitions hold disjoint months in order, so reading them one after another keeps the sort order;
+        # partitions lying entirely before the offset are skipped by their count
+        remaining = limit
+        for partition in partitions:
+            if offset:
+                count = partition.count_documents(query)
+                if count <= offset:
+                    offset -= count
+                    continue
+            cursor = partition.find(query, {"_id": 0, "region": 0}).sort(activity_sort)
+            if offset:
+                cursor = cursor.skip(offset)
+                offset = 0
+            if limit:
+                cursor = cursor.limit(remaining)
+            for item in cursor:
+                yield item
+                remaining -= 1
+            if limit and remaining <= 0:
+                return
+
+    def _count_activities(self, query, date_from="", date_to=""):
+        return sum(partition.count_documents(query)
+                   for partition in self._activity_partitions(date_from=date_from, date_to=date_to))
 
     def delete_data(self, collection, region=None):
         try:
             # current collections
             if collection == "activity":
-                self._activity.delete_many({"Meeting_ID": {"$regex": region}})
-                logger.debug("Current Activity CDO deleted for country {0}".format(region.pattern))
+                self._activity.delete_many({"region": region})
+                logger.debug("Current Activity CDO deleted for country {0}".format(region))
             if collection == "institution":
-                self._institution.delete_many({"IM_CRM_Institution_ID": {"$regex": region}})
-                logger.debug("Current Institution CDO deleted for country {0}".format(region.pattern))
+                self._institution.delete_many({"region": region})
+                logger.debug("Current Institution CDO deleted for country {0}".format(region))
             if collection == "contact":
-                self._contact.delete_many({"C_IM_CRM_Security_Label1": {"$regex": region}})
-                logger.debug("Current Contact deleted for region {0} ".format(region.pattern))
+                self._contact.delete_many({"region": region})
+                logger.debug("Current Contact deleted for region {0} ".format(region))
             # filter also by status
             if collection == "personActivity":
-                self._personActivity.delete_many({"IM_CRM_Meeting_ID": {"$regex": region}})
-                logger.debug("Current Person Activity deleted for country {0}".format(region.pattern))
+                self._personActivity.delete_many({"region": region})
+                logger.debug("Current Person Activity deleted for country {0}".format(region))
             if collection == "personInstitution":
-                self._personInstitution.delete_many({"IM_CRM_Institution_ID": {"$regex": region}})
-                logger.debug("Current Person Institution deleted for country {0}".format(region.pattern))
+                self._personInstitution.delete_many({"region": region})
+                logger.debug("Current Person Institution deleted for country {0}".format(region))
             # past collections
             if collection == "activityPast":
-                self._activityPast.delete_many({"Meeting_ID": {"$regex": region}})
-                logger.debug("Past Activity CDO deleted for country {0}".format(region.pattern))
+                self._activityPast.delete_many({"region": region})
+                logger.debug("Past Activity CDO deleted for country {0}".format(region))
             if collection == "institutionPast":
-                self._institutionPast.delete_many({"IM_CRM_Institution_ID": {"$regex": region}})
-                logger.debug("Past Institution CDO deleted for country {0}".format(region.pattern))
+                self._institutionPast.delete_many({"region": region})
+                logger.debug("Past Institution CDO deleted for country {0}".format(region))
             # filter also by status
             if collection == "contactPast":
-                self._contactPast.delete_many({"C_IM_CRM_Security_Label1": {"$regex": region}})
-                logger.debug("Past Contact deleted for region {0}".format(region.pattern))
+                self._contactPast.delete_many({"region": region})
+                logger.debug("Past Contact deleted for region {0}".format(region))
             # all activities collection
             if collection == "allActivities":
+                for partition in self._activity_partitions():
+                    partition.drop()
+                    _indexed_partitions.discard(partition.name)
                 self._allActivities.delete_many({})
-            # joined collections
-            if collection == "joinedActivity":
-                self._joinedActivity.delete_many({})
-                logger.debug("Joined Activity CDO deleted")
-            if collection == "joinedInstitution":
-                self._joinedInstitution.delete_many({})
-                logger.debug("Joined Institution CDO deleted")
         except:
             logger.debug("No data existed in {0} collection yet to be emptied for region {1}".format(collection, region))
 
-    def move_data_past(self, collection, data, region):
-        if collection == "activityPast":
-            if data:
-                # delete old past data
-                self.delete_data(collection="activityPast", region=region)
-                # archive current data
-                self.insert_data(collection="activityPast", data=data)
-            else:
-                logger.debug("No new Activity CDO to archive")
-            # empty current collections (raw and joined) awaiting for new data coming in
-            self.delete_data(collection="activity", region=region)
-            self.delete_data(collection="personActivity", region=region)
-            self.delete_data(collection="joinedActivity")
-            logger.debug("Activity CDO daily operations "
-                         "(archive data and empty current collection) "
-                         "complete for country {0}".format(region.pattern))
-        if collection == "institutionPast":
-            if data:
-                self.delete_data(collection="institutionPast", region=region)
-                self.insert_data(collection="institutionPast", data=data)
-            else:
-                logger.debug("No new Institution CDO to archive")
-            self.delete_data(collection="institution", region=region)
-            self.delete_data(collection="personInstitution", region=region)
-            self.delete_data(collection="joinedInstitution")
-            logger.debug("Institution CDO daily operations "
-                         "(archive data and empty current collection) "
-                         "complete for country {0}".format(region.pattern))
-        if collection == "contactPast":
-            if data:
-                # delete old past data
-                self.delete_data(collection="contactPast", region=region)
-                # archive current data, marked status as imported to Eloqua
-                self.insert_data(collection="contactPast", data=data)
-            else:
-                logger.debug("No new Contact to archive")
-            # empty current collection awaiting for new data coming in
-            self.delete_data(collection="contact", region=region)
-            logger.debug("Contact daily operations "
-                         "(archive data and empty current collection) "
-                         "complete for region {0}".format(region.pattern))
+    def move_data_past(self, collection, data, region, batch_size=1000):
+        # changed records are upserted into the archive, unchanged ones are never rewritten;
+        # the upserts are idempotent, so a run that crashed before emptying the current
+        # collections archives the same documents again and carries on
+        if data:
+            key = archive_keys[collection]
+            archived = 0
+            requests = []
+            for item in data:
+                document = {field: value for field, value in item.items() if field not in unhashed_fields}
+                document.update({"region": region, "content_hash": content_hash(document)})
+                # replaced whole, a field missing from today's record must not survive from an older version
+                requests.append(ReplaceOne({"region": region, key: document.get(key)}, document, upsert=True))
+                if len(requests) == batch_size:
+                    result = self._database[collection].bulk_write(requests)
+                    archived += result.upserted_count + result.modified_count
+                    requests = []
+            if requests:
+                result = self._database[collection].bulk_write(requests)
+                archived += result.upserted_count + result.modified_count
+            logger.debug("{0} records archived to {1} for region {2}".format(archived, collection, region))
+        else:
+            logger.debug("No new data to archive to {0} for region {1}".format(collection, region))
+        # empty current collections awaiting for new data coming in
+        for current in archive_sources[collection]:
+            self.delete_data(collection=current, region=region)
+        logger.debug("{0} daily operations (archive data and empty current collection) complete for region {1}".format(
+            collection, region))
@@ -1,23 +1,89 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
+import re
+import time
 
+from dateutil import parser as date_parser
 from dea.bulk.api import BulkClient
 from dea.bulk.definitions import ExportDefinition
-from dea.rest.api.cdo import RestCdoClient
+import requests
 from requests.auth import HTTPBasicAuth
 
 import config
+from export_definitions import ExportDefinitionCache
 from logging_config import setup_logging
 
 logger = setup_logging(__name__)
 
 
+eloqua_date_format = "%Y-%m-%d %H:%M:%S"
+
+# maximum number of rows a single bulk export sync returns
+sync_limit = 50000
+# contacts per PageView export, same default as ELQ_PAGE_VIEW_CONTACT_CHUNK_SIZE
+page_view_contact_chunk_size = 50
+# lower bound of activity exports without a watermark or configured history start
+default_history_start = datetime(2000, 1, 1)
+
+rest_api_path = "/api/REST/1.0"
+rest_page_size = 1000
+# REST contact properties holding the standard contact fields, all other fields are in fieldValues
+rest_contact_properties = {
+    "C_EmailAddress": "emailAddress",
+    "C_FirstName": "firstName",
+    "C_LastName": "lastName",
+    "C_MobilePhone": "mobilePhone",
+    "C_Salutation": "salutation",
+    "C_Country": "country",
+    "C_Company": "accountName",
+    "C_Address1": "address1",
+    "C_State_Prov": "province",
+    "C_City": "city",
+    "C_Zip_Postal": "postalCode",
+    "C_Title": "title",
+}
+
+
+def contact_field_name(statement):
+    # "{{Contact.Field(C_FirstName)}}" -> "C_FirstName"
+    match = re.search(r"Contact\.Field\((\w+)\)", str(statement))
+    if match:
+        return match.group(1)
+    return None
+
+
+def activity_key(activity):
+    # activity ids are only unique within an activity type
+    return activity.get("ActivityType"), activity.get("ActivityId")
+
+
 class ElqClient:
-    def __init__(self, username, password, base_url):
+    def __init__(self, username, password, base_url, export_def_cache_path=None, export_def_cache_size=100,
+                 rest_max_rows=0, rest_max_days=7, session=None, governor=None):
         self.bulk_client = BulkClient(auth=HTTPBasicAuth(username=username, password=password), base_url=base_url)
-        self.rest_client = RestCdoClient(auth=HTTPBasicAuth(username=username, password=password), base_url=base_url)
+        # callers should pass the shared pooled session from eloqua_session.get_session()
+        if session is None:
+            session = requests.Session()
+            session.auth = HTTPBasicAuth(username=username, password=password)
+        self.session = session
+        # rate governor of the shared session, also applied to the dea bulk exports
+        self.governor = governor
+        self.rest_url = base_url.rstrip("/") + rest_api_path
+        # contact reads matching at most rest_max_rows use the REST API instead of a bulk export,
+        # only date ranges of at most rest_max_days are probed (rest_max_rows=0 disables it)
+        self.rest_max_rows = rest_max_rows
+        self.rest_max_days = rest_max_days
+        self._rest_field_names = None
+        self.export_definitions = None
+        if export_def_cache_path:
+            self.export_definitions = ExportDefinitionCache(session=self.session, base_url=base_url,
+                                                            path=export_def_cache_path,
+                                                            max_definitions=export_def_cache_size)
 
     def export_contact(self, date_from, date_to, region):
-        contacts = []
+        return list(self.iter_contact(date_from=date_from, date_to=date_to, region=region))
+
+    def iter_contact(self, date_from, date_to, region):
         # define filter
         if date_from and date_to:
             filters = "'{0}'>'{1}' AND '{2}'<'{3}' AND '{4}'='{5}'".format("{{Contact.Field(C_DateCreated)}}",
@@ -40,20 +106,18 @@ class ElqClient:
             filters = "'{0}'='{1}'".format("{{Contact.Field(C_IM_CRM_Security_Label1)}}",
                                            region)
         fields = config.contact_export_def
-        if filters:
-            export_def = ExportDefinition(name="contact_export_def", fields=fields, filter=filters)
-            contact_export = self.bulk_client.bulk_contacts.exports.create_export(export_def=export_def,
-                                                                                  delete_export_on_close=True,
-                                                                                  sync_limit=50000)
-        else:
-            export_def = ExportDefinition(name="contact_export_def", fields=fields)
-            contact_export = self.bulk_client.bulk_contacts.exports.create_export(export_def=export_def,
-                                                                                  delete_export_on_close=True,
-                                                                                  sync_limit=50000)
-
-        for items in contact_export:
-            contacts.append(items)
-        return contacts
+        if self._is_narrow(date_from=date_from, date_to=date_to):
+            search = "{0}='{1}'createdAt>'{2}'createdAt<'{3}'".format("C_IM_CRM_Security_Label1", region,
+                                                                       date_from, date_to)
+            if self._use_rest(search=search):
+                for item in self._iter_rest_contacts(search=search, fields=fields):
+                    yield item
+                return
+        # only the date free shape recurs, dated filters are one-off exports deleted after their sync
+        for item in self._export_all(entity="contacts", name="contact_export_def", fields=fields, filter=filters,
+                                     date_field="{{Contact.Field(C_DateCreated)}}", date_from=date_from,
+                                     date_to=date_to, reuse=not date_from and not date_to):
+            yield item
 
     def export_contact_with_crm_id(self, first_run):
         field = config.contact_crm_id_export_def
@@ -66,57 +130,270 @@ class ElqClient:
                                                                             past_time,
                                                                             "{{Contact.Field(C_DateModified)}}",
                                                                             current_time)
-        export_def = ExportDefinition(name="contact_crm_id_export_def", fields=field, filter=filter)
-        contact_export = self.bulk_client.bulk_contacts.exports.create_export(export_def=export_def,
-                                                                              delete_export_on_close=True,
-                                                                              sync_limit=50000)
-        return list(contact_export)
+        if not first_run and self._is_narrow(date_from=past_time, date_to=current_time):
+            search = "updatedAt>='{0}'updatedAt<'{1}'".format(past_time, current_time)
+            if self._use_rest(search=search):
+                # REST search cannot express a non-empty field, filter it here
+                return [contact for contact in self._iter_rest_contacts(search=search, fields=field)
+                        if contact.get("C_IM_CRM_Contact_ID1")]
+        return self._export_all(entity="contacts", name="contact_crm_id_export_def", fields=field, filter=filter,
+                                date_field="{{Contact.Field(C_DateModified)}}",
+                                date_from=None if first_run else past_time, date_to=None if first_run else current_time,
+                                reuse=first_run)
+
+    def _is_narrow(self, date_from, date_to):
+        if not self.rest_max_rows or not date_from or not date_to:
+            return False
+        return date_parser.parse(date_to) - date_parser.parse(date_from) <= timedelta(days=self.rest_max_days)
+
+    def _use_rest(self, search):
+        # a one-row page is enough to learn how many contacts match
+        try:
+            total = self._rest_get("/data/contacts", params={"search": search, "depth": "minimal", "count": 1,
+                                                             "page": 1}).get("total", 0)
+        except (requests.RequestException, ValueError) as e:
+            logger.debug("Cannot estimate contact count through REST, using bulk export: {0}".format(e))
+            return False
+        logger.debug("{0} contacts match '{1}', using {2}".format(total, search,
+                                                                   "REST" if total <= self.rest_max_rows else "bulk"))
+        return total <= self.rest_max_rows
+
+    def _iter_rest_contacts(self, search, fields):
+        field_names = self._get_rest_field_names()
+        page = 1
+        while True:
+            body = self._rest_get("/data/contacts", params={"search": search, "depth": "complete",
+                                                            "count": rest_page_size, "page": page})
+            for element in body.get("elements", []):
+                yield self._rest_contact_row(element=element, fields=fields, field_names=field_names)
+            if page * rest_page_size >= body.get("total", 0):
+                break
+            page += 1
 
-    def export_all_activities_with_contact(self, current_activity_data_in_db):
+    def _rest_contact_row(self, element, fields, field_names):
+        # shape a REST contact like a row of a bulk export with the same fields
+        values = {field_names.get(value.get("id")): value.get("value", "") for value in element.get("fieldValues", [])}
+        row = {}
+        for name, statement in fields.items():
+            field_name = contact_field_name(statement)
+            if field_name is None:
+                row[name] = element.get("id", "")
+            elif field_name in rest_contact_properties:
+                row[name] = element.get(rest_contact_properties[field_name], "")
+            else:
+                row[name] = values.get(field_name, "")
+        return row
+
+    def _get_rest_field_names(self):
+        # contact field id -> internal name, loaded once per client
+        if self._rest_field_names is None:
+            field_names = {}
+            page = 1
+            while True:
+                body = self._rest_get("/assets/contact/fields", params={"depth": "partial", "count": rest_page_size,
+                                                                         "page": page})
+                for element in body.get("elements", []):
+                    field_names[element.get("id")] = element.get("internalName")
+                if page * rest_page_size >= body.get("total", 0):
+                    break
+                page += 1
+            self._rest_field_names = field_names
+        return self._rest_field_names
+
+    def _rest_get(self, path, params):
+        response = self.session.get(self.rest_url + path, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def export_all_activities_with_contact(self, watermarks=None, overlap=timedelta(0), max_workers=1,
+                                           history_start=None, window=timedelta(days=30), window_workers=1):
+        # watermarks maps an activity type to the latest Activity.CreatedAt already stored,
+        # only activities created since then (minus overlap) are exported.
+        # without a watermark the export starts at history_start (default_history_start if None)
         activities = []
+        exported_keys = set()
+        new_watermarks = {}
+        timings = {}
         count = 0
         activity_types = ["EmailSend", "EmailOpen", "EmailClickthrough", "Subscribe",
                           "Unsubscribe", "Bounceback", "FormSubmit", "WebVisit"]
-        for activity_type in activity_types:
-            logger.debug("Start exporting data for {0} Activity with Contact details".format(activity_type))
-            filter = "'{0}'='{1}' AND NOT '{2}'=''".format("{{Activity.Type}}",
-                                                           activity_type,
-                                                           "{{Activity.Contact.Field(C_IM_CRM_Contact_ID1)}}")
-            fields = config.activity_with_contact_export_def[activity_type]
-            export_def = ExportDefinition(name=activity_type.lower() + "_with_contact_export_def", fields=fields,
-                                          filter=filter)
-            activity_export = list(self.bulk_client.bulk_activities.exports.create_export(export_def=export_def,
-                                                                                          delete_export_on_close=True,
-                                                                                          sync_limit=50000))
-            if activity_export:
+        # Eloqua runs the syncs server side, so several types can be created and polled at once
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for activity_type in activity_types:
+                watermark = (watermarks or {}).get(activity_type)
+                since = date_parser.parse(watermark) - overlap if watermark else history_start
+                futures[executor.submit(self._export_activity_type, activity_type, since, window,
+                                        window_workers)] = activity_type
+            for future in as_completed(futures):
+                activity_type = futures[future]
+                activity_export, latest, timings[activity_type] = future.result()
                 for activity in activity_export:
-                    if activity not in current_activity_data_in_db:
+                    key = activity_key(activity)
+                    if key not in exported_keys:
+                        exported_keys.add(key)
                         activities.append(activity)
-                count += len(activity_export)
-                logger.debug("Finish exporting {0} Activity with Contact details".format(activity_type))
-            else:
-                logger.debug("No {0} Activity with Contact details exported.".format(activity_type))
-        return activities, count
+                if activity_export:
+                    count += len(activity_export)
+                    if latest:
+                        new_watermarks[activity_type] = latest.strftime(eloqua_date_format)
+                    logger.debug("Finish exporting {0} Activity with Contact details in {1:.1f}s".format(
+                        activity_type, timings[activity_type]))
+                else:
+                    logger.debug("No {0} Activity with Contact details exported.".format(activity_type))
+        logger.debug("Activity export timings: {0}".format(
+            ", ".join("{0} {1:.1f}s".format(activity_type, timings[activity_type]) for activity_type in activity_types)))
+        return activities, count, new_watermarks
+
+    def _export_activity_type(self, activity_type, since, window, window_workers):
+        started = time.monotonic()
+        logger.debug("Start exporting data for {0} Activity with Contact details".format(activity_type))
+        filter = "'{0}'='{1}' AND NOT '{2}'=''".format("{{Activity.Type}}",
+                                                       activity_type,
+                                                       "{{Activity.Contact.Field(C_IM_CRM_Contact_ID1)}}")
+        fields = config.activity_with_contact_export_def[activity_type]
+        name = activity_type.lower() + "_with_contact_export_def"
+        # windowed even without a watermark, so no single sync can be cut off at sync_limit
+        activity_export, complete = self.export_windowed(entity="activities",
+                                                         name=name, fields=fields, filter=filter,
+                                                         date_field="{{Activity.CreatedAt}}",
+                                                         date_from=since or default_history_start,
+                                                         # a day ahead, so the instance time zone never cuts off today
+                                                         date_to=datetime.utcnow() + timedelta(days=1),
+                                                         window=window, max_workers=window_workers)
+        latest = None
+        if not complete:
+            # rows dropped by a truncated window would sit below the watermark and never be exported again
+            logger.warning("{0} Activity export was truncated at the sync limit, "
+                           "its watermark is not advanced".format(activity_type))
+            return activity_export, latest, time.monotonic() - started
+        for activity in activity_export:
+            if activity.get("ActivityDate"):
+                created_at = date_parser.parse(activity["ActivityDate"])
+                if latest is None or created_at > latest:
+                    latest = created_at
+        return activity_export, latest, time.monotonic() - started
+
+    def export_windowed(self, entity, name, fields, filter, date_field, date_from, date_to,
+                        window=timedelta(days=30), max_workers=1, min_window=timedelta(minutes=1)):
+        # split [date_from, date_to) into windows that each stay under sync_limit:
+        # a window that hits the limit is bisected and exported again, and the size of the
+        # next window is derived from the row density observed so far.
+        # returns the rows and whether every window stayed under the limit
+        rows = []
+        complete = True
+        pending = []
+        cursor = date_from
+        span = window
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or cursor < date_to or in_flight:
+                while len(in_flight) < max_workers and (pending or cursor < date_to):
+                    if pending:
+                        window_from, window_to = pending.pop()
+                    else:
+                        window_from, window_to = cursor, min(cursor + span, date_to)
+                        cursor = window_to
+                    window_filter = "{0} AND '{1}'>='{2}' AND '{3}'<'{4}'".format(
+                        filter, date_field, window_from.strftime(eloqua_date_format),
+                        date_field, window_to.strftime(eloqua_date_format))
+                    future = executor.submit(self._export, entity, name, fields, window_filter)
+                    in_flight[future] = (window_from, window_to)
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window_from, window_to = in_flight.pop(future)
+                    window_rows = future.result()
+                    if len(window_rows) >= sync_limit and window_to - window_from > min_window:
+                        middle = window_from + (window_to - window_from) / 2
+                        pending.extend([(middle, window_to), (window_from, middle)])
+                        span = min(span, middle - window_from)
+                        logger.debug("Export window {0} to {1} hit the sync limit, splitting it".format(window_from,
+                                                                                                        window_to))
+                        continue
+                    if len(window_rows) >= sync_limit:
+                        complete = False
+                        logger.warning("Export window {0} to {1} still hits the sync limit of {2}, "
+                                       "rows may be missing".format(window_from, window_to, sync_limit))
+                    rows.extend(window_rows)
+                    # aim for windows of about half the sync limit
+                    if window_rows:
+                        density = len(window_rows) / (window_to - window_from).total_seconds()
+                        span = timedelta(seconds=sync_limit / 2 / density)
+                    else:
+                        span = span * 2
+                    span = max(min(span, date_to - date_from), min_window)
+        return rows, complete
 
-    def export_page_view_with_contact(self, first_run, current_page_view_data_in_db):
+    def _export_all(self, entity, name, fields, filter, date_field, date_from=None, date_to=None, reuse=False):
+        # one sync first; only when it comes back full is the export redone in date windows of date_field,
+        # within date_from/date_to when given or over the whole history otherwise
+        rows = self._export(entity=entity, name=name, fields=fields, filter=filter, reuse=reuse)
+        if len(rows) < sync_limit:
+            return rows
+        logger.debug("Export {0} hit the sync limit of {1}, exporting it in date windows".format(name, sync_limit))
+        rows, complete = self.export_windowed(entity=entity, name=name, fields=fields, filter=filter,
+                                              date_field=date_field,
+                                              date_from=date_parser.parse(date_from) if date_from
+                                              else default_history_start,
+                                              # a day ahead, so the instance time zone never cuts off today
+                                              date_to=date_parser.parse(date_to) if date_to
+                                              else datetime.utcnow() + timedelta(days=1))
+        if not complete:
+            logger.warning("Export {0} was truncated at the sync limit, rows are missing".format(name))
+        return rows
+
+    def _export(self, entity, name, fields, filter, reuse=False):
+        return list(self._iter_export(entity=entity, name=name, fields=fields, filter=filter, reuse=reuse))
+
+    def _iter_export(self, entity, name, fields, filter, reuse=False):
+        # recurring export shapes reuse a cached definition, one-off ones are created and deleted around the sync
+        if reuse and self.export_definitions:
+            return self.export_definitions.export(entity=entity, name=name, fields=fields, filter=filter,
+                                                  limit=sync_limit)
+        exports = getattr(self.bulk_client, "bulk_" + entity).exports
+        if filter:
+            export_def = ExportDefinition(name=name, fields=fields, filter=filter)
+        else:
+            export_def = ExportDefinition(name=name, fields=fields)
+        return self._iter_dea_export(exports=exports, export_def=export_def)
+
+    def _iter_dea_export(self, exports, export_def):
+        # dea uses its own HTTP session, so the whole sync holds one slot of the governor. the rows (at most
+        # sync_limit) are read while holding it and handed out after, a slow consumer must not keep the slot
+        if self.governor is None:
+            yield from exports.create_export(export_def=export_def, delete_export_on_close=True, sync_limit=sync_limit)
+            return
+        with self.governor.acquire():
+            rows = list(exports.create_export(export_def=export_def, delete_export_on_close=True,
+                                              sync_limit=sync_limit))
+        yield from rows
+
+    def export_page_view_with_contact(self, first_run, contact_chunk_size=page_view_contact_chunk_size,
+                                      max_workers=1):
         output = []
+        exported_keys = set()
         past_time, current_time = self.get_last_24_hours_date()
         field = config.activity_with_contact_export_def["PageView"]
         # export all PageView for contacts that got updated in last 24 hours
         contacts = self.export_contact_with_crm_id(first_run=first_run)
         if contacts:
-            for contact in contacts:
-                contact_id = contact.get("id", None)
-                filter = "'{0}'='{1}' AND '{2}'='{3}'".format("{{Activity.Contact.Id}}", contact_id,
-                                                              "{{Activity.Type}}", "PageView")
-                export_def = ExportDefinition(name="pageview_with_crm_id_export_def", fields=field, filter=filter)
-                page_view_export = self.bulk_client.bulk_activities.exports.create_export(export_def=export_def,
-                                                                                          delete_export_on_close=True,
-                                                                                          sync_limit=50000)
-                for i in page_view_export:
-                    output.append(i)
+            # one export per chunk of contacts instead of one per contact
+            # a contact without an id would put a '' comparison into the OR filter
+            contact_ids = [contact.get("id") for contact in contacts if contact.get("id")]
+            chunks = [contact_ids[start:start + contact_chunk_size]
+                      for start in range(0, len(contact_ids), contact_chunk_size)]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for page_view_export in executor.map(self._export_page_view_for_contacts, chunks):
+                    for page_view in page_view_export:
+                        key = activity_key(page_view)
+                        if key not in exported_keys:
+                            exported_keys.add(key)
+                            output.append(page_view)
             logger.debug("Finish exporting PageView Activity with Contact details "
-                         "(for contacts updated from {0} to {1}".format(past_time, current_time))
+                         "(for {0} contacts in {1} exports, updated from {2} to {3}".format(len(contact_ids),
+                                                                                            len(chunks),
+                                                                                            past_time,
+                                                                                            current_time))
         else:
             logger.debug("No PageView Activity with Contact details exported. "
                          "No contacts updated from {0} to {1}".format(past_time, current_time))
@@ -127,18 +404,25 @@ class ElqClient:
                                                                                         past_time,
                                                                                         "{{Activity.CreatedAt}}",
                                                                                         current_time)
-        export_def_by_day = ExportDefinition(name="pageview_with_crm_id_export_def", fields=field,
-                                             filter=filter_page_view_by_day)
-        page_view_by_day = self.bulk_client.bulk_activities.exports.create_export(export_def=export_def_by_day,
-                                                                                  delete_export_on_close=True,
-                                                                                  sync_limit=50000)
+        page_view_by_day = self._export_all(entity="activities", name="pageview_with_crm_id_export_def",
+                                            fields=field, filter=filter_page_view_by_day,
+                                            date_field="{{Activity.CreatedAt}}", date_from=past_time,
+                                            date_to=current_time)
         for page_view in page_view_by_day:
-            if page_view.get("C_IM_CRM_Contact_ID1", None) and \
-                    page_view not in output and \
-                    page_view not in current_page_view_data_in_db:
+            key = activity_key(page_view)
+            if page_view.get("C_IM_CRM_Contact_ID1", None) and key not in exported_keys:
+                exported_keys.add(key)
                 output.append(page_view)
         return output, len(output)
 
+    def _export_page_view_for_contacts(self, contact_ids):
+        field = config.activity_with_contact_export_def["PageView"]
+        contact_filter = " OR ".join("'{0}'='{1}'".format("{{Activity.Contact.Id}}", contact_id)
+                                     for contact_id in contact_ids)
+        filter = "'{0}'='{1}' AND ({2})".format("{{Activity.Type}}", "PageView", contact_filter)
+        return self._export_all(entity="activities", name="pageview_with_crm_id_export_def", fields=field,
+                                filter=filter, date_field="{{Activity.CreatedAt}}")
+
     def get_last_24_hours_date(self):
         current = datetime.utcnow().date()
         past = current - timedelta(days=1)
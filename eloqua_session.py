@@ -0,0 +1,87 @@
+import os
+import threading
+
+import requests
+from requests.auth import HTTPBasicAuth
+
+import settings
+from bulk_imports import BulkImporter
+from eloqua_client import ElqClient
+from logging_config import setup_logging
+from rate_limiter import GovernedAdapter, GovernedRetry, RateGovernor
+
+logger = setup_logging(__name__)
+
+_lock = threading.RLock()
+_pid = None
+_session = None
+_clients = {}
+# shared by every thread of the process, Eloqua limits apply to the whole instance
+_governor = RateGovernor(rate=settings.ELQ_RATE_LIMIT_PER_SECOND, burst=settings.ELQ_RATE_LIMIT_BURST,
+                         max_concurrent=settings.ELQ_MAX_CONCURRENT_CALLS)
+
+
+def _reset_after_fork():
+    # sessions and clients inherited through fork() are rebuilt in the child
+    global _pid, _session
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _session = None
+        _clients.clear()
+
+
+def get_governor():
+    return _governor
+
+
+def get_session():
+    global _session
+    with _lock:
+        _reset_after_fork()
+        if _session is None:
+            retry = GovernedRetry(total=settings.ELQ_HTTP_RETRIES,
+                                  backoff_factor=settings.ELQ_HTTP_BACKOFF_FACTOR,
+                                  status_forcelist=(429, 500, 502, 503, 504),
+                                  respect_retry_after_header=True,
+                                  raise_on_status=False)
+            retry.governor = _governor
+            adapter = GovernedAdapter(_governor,
+                                      pool_connections=settings.ELQ_HTTP_POOL_SIZE,
+                                      pool_maxsize=settings.ELQ_HTTP_POOL_SIZE,
+                                      max_retries=retry)
+            session = requests.Session()
+            session.auth = HTTPBasicAuth(username=settings.ELQ_USER, password=settings.ELQ_PASSWORD)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            logger.debug("Created Eloqua HTTP session for process {0}".format(_pid))
+        return _session
+
+
+def _get_client(name, build):
+    with _lock:
+        _reset_after_fork()
+        if name not in _clients:
+            _clients[name] = build()
+        return _clients[name]
+
+
+def get_elq_client():
+    return _get_client("elq", lambda: ElqClient(username=settings.ELQ_USER,
+                                                password=settings.ELQ_PASSWORD,
+                                                base_url=settings.ELQ_BASE_URL,
+                                                export_def_cache_path=settings.ELQ_EXPORT_DEF_CACHE_PATH,
+                                                export_def_cache_size=settings.ELQ_EXPORT_DEF_CACHE_SIZE,
+                                                rest_max_rows=settings.ELQ_REST_MAX_ROWS,
+                                                rest_max_days=settings.ELQ_REST_MAX_DAYS,
+                                                session=get_session(),
+                                                governor=_governor))
+
+
+def get_bulk_importer():
+    return _get_client("bulk_importer", lambda: BulkImporter(session=get_session(),
+                                                             base_url=settings.ELQ_BASE_URL,
+                                                             batch_size=settings.ELQ_IMPORT_BATCH_SIZE,
+                                                             max_workers=settings.ELQ_IMPORT_BATCH_WORKERS,
+                                                             sync_every=settings.ELQ_IMPORT_SYNC_EVERY_BATCHES,
+                                                             batch_retries=settings.ELQ_IMPORT_BATCH_RETRIES))
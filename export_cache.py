@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+
+from logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+
+class ExportCache:
+    # size-bounded LRU cache of exported rows with a time to live, optionally
+    # mirrored to a directory so several worker processes share the entries
+    def __init__(self, ttl, max_entries, directory=None):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                expires, rows = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    return rows
+                del self._entries[key]
+        entry = self._read(key)
+        if entry:
+            expires, rows = entry
+            if expires > now:
+                self._store(key, expires, rows)
+                return rows
+        return None
+
+    def set(self, key, rows):
+        expires = time.time() + self._ttl
+        self._store(key, expires, rows)
+        self._write(key, expires, rows)
+
+    def _store(self, key, expires, rows):
+        with self._lock:
+            self._entries[key] = (expires, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+        name = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self._directory, name + ".json")
+
+    def _read(self, key):
+        if not self._directory:
+            return None
+        try:
+            with open(self._path(key), "r") as f:
+                entry = json.load(f)
+            return entry["expires"], entry["rows"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, key, expires, rows):
+        if not self._directory:
+            return
+        path = self._path(key)
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"expires": expires, "rows": rows}, f)
+            os.replace(tmp_path, path)
+            self._prune()
+        except OSError as e:
+            logger.debug("Cannot write export cache entry {0}: {1}".format(path, e))
+
+    def _prune(self):
+        # drop expired files and the least recently written ones beyond max_entries
+        now = time.time()
+        paths = [os.path.join(self._directory, name) for name in os.listdir(self._directory)
+                 if name.endswith(".json")]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for index, path in enumerate(paths):
+            if index >= self._max_entries or os.path.getmtime(path) + self._ttl < now:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
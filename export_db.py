@@ -1,40 +1,65 @@
 import settings
 from app import app
 from database import get_db
-from eloqua_client import ElqClient
+from eloqua_session import get_elq_client
 from logging_config import setup_logging
 
 import argparse
+from datetime import timedelta
+
+from dateutil import parser as date_parser
 
 logger = setup_logging(__name__)
 
 
-def import_to_db(first_run):
+def import_to_db(first_run, batch_size, full_resync, workers):
     with app.app_context():
         db = get_db()
-        client = ElqClient(username=settings.ELQ_USER,
-                           password=settings.ELQ_PASSWORD,
-                           base_url=settings.ELQ_BASE_URL)
-        # insert all activities
-        data, total_count = client.export_all_activities_with_contact(current_activity_data_in_db=db.get_all_activities_data())
+        client = get_elq_client()
+        # upsert activities created since the last sync, duplicates are resolved by the unique activity index
+        watermarks = {} if full_resync else db.get_sync_watermarks()
+        overlap = timedelta(hours=settings.ACTIVITY_SYNC_OVERLAP_HOURS)
+        history_start = date_parser.parse(settings.ELQ_EXPORT_HISTORY_START) if settings.ELQ_EXPORT_HISTORY_START \
+            else None
+        data, total_count, new_watermarks = client.export_all_activities_with_contact(
+            watermarks=watermarks,
+            overlap=overlap,
+            max_workers=workers,
+            history_start=history_start,
+            window=timedelta(days=settings.ELQ_EXPORT_WINDOW_DAYS),
+            window_workers=settings.ELQ_EXPORT_WINDOW_WORKERS)
         if data:
-            db.insert_data(data=data, collection="allActivities")
+            db.upsert_activities(data=data, batch_size=batch_size)
             logger.debug("{0} Activity with Contact details imported to DB".format(total_count))
         else:
             logger.debug("No new Activity with Contact details imported to DB.")
-        # insert PageView activity separately
-        page_view_data, page_view_total_count = client.export_page_view_with_contact(first_run=first_run,
-                                                                                     current_page_view_data_in_db=db.get_all_activities_data(type="PageView"))
+        # only move watermarks once the activities are stored
+        for activity_type, watermark in new_watermarks.items():
+            db.set_sync_watermark(name=activity_type, watermark=watermark)
+        # upsert PageView activity separately
+        page_view_data, page_view_total_count = client.export_page_view_with_contact(
+            first_run=first_run,
+            contact_chunk_size=settings.ELQ_PAGE_VIEW_CONTACT_CHUNK_SIZE,
+            max_workers=workers)
         if page_view_data:
-            db.insert_data(data=page_view_data, collection="allActivities")
+            db.upsert_activities(data=page_view_data, batch_size=batch_size)
             logger.debug("{0} PageView Activity with Contact details imported to DB".format(page_view_total_count))
         else:
             logger.debug("No new PageView Activity with Contact details imported to DB.")
+        # monthly activity partitions past the retention are dropped whole
+        db.apply_activity_retention(months=settings.ACTIVITY_RETENTION_MONTHS)
 
 
 if __name__ == '__main__':
     # add first run arg
     parser = argparse.ArgumentParser()
     parser.add_argument("--first_run", type=int, help="input 1 for first run, default is 0", default=0)
-    first_run = parser.parse_args().first_run
-    import_to_db(first_run=first_run)
+    parser.add_argument("--batch_size", type=int, help="number of activities per DB write, default is {0}".format(
+        settings.ACTIVITY_UPSERT_BATCH_SIZE), default=settings.ACTIVITY_UPSERT_BATCH_SIZE)
+    parser.add_argument("--full_resync", type=int,
+                        help="input 1 to export all activities regardless of the last sync, default is 0", default=0)
+    parser.add_argument("--workers", type=int, help="number of activity types exported at once, default is {0}".format(
+        settings.ELQ_EXPORT_WORKERS), default=settings.ELQ_EXPORT_WORKERS)
+    args = parser.parse_args()
+    import_to_db(first_run=args.first_run, batch_size=args.batch_size, full_resync=args.full_resync,
+                 workers=args.workers)
@@ -0,0 +1,176 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+from logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+bulk_api_path = "/api/bulk/2.0"
+# seconds between two sync status checks
+sync_poll_interval = 2
+# maximum page size of the sync data endpoint
+sync_page_size = 50000
+
+
+def definition_key(entity, name, fields, filter):
+    # fields are part of the key, so a changed config.py mapping gets a new definition
+    canonical = json.dumps([entity, name, fields, filter], sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def run_sync(session, bulk_url, uri):
+    # start a sync of an export or import definition and wait until Eloqua has finished it
+    response = session.post(bulk_url + "/syncs", json={"syncedInstanceUri": uri})
+    response.raise_for_status()
+    sync_uri = response.json()["uri"]
+    while True:
+        response = session.get(bulk_url + sync_uri)
+        response.raise_for_status()
+        status = response.json()["status"]
+        if status not in ("pending", "active"):
+            break
+        time.sleep(sync_poll_interval)
+    if status not in ("success", "warning"):
+        raise RuntimeError("Eloqua sync {0} of {1} finished with status {2}".format(sync_uri, uri, status))
+    return sync_uri
+
+
+class ExportDefinitionCache:
+    # export definitions created once on Eloqua and synced again on every use,
+    # their URIs are persisted in a local JSON file so they survive restarts.
+    # the file is shared by all processes: every change re-reads it and is written back under a file lock
+    def __init__(self, session, base_url, path, max_definitions=100):
+        self._session = session
+        self._bulk_url = base_url.rstrip("/") + bulk_api_path
+        self._path = path
+        self._max_definitions = max_definitions
+        self._lock = threading.Lock()
+        self._definitions = self._load()
+
+    def export(self, entity, name, fields, filter, limit):
+        key = definition_key(entity=entity, name=name, fields=fields, filter=filter)
+        uri = self._get_uri(key=key, entity=entity, name=name, fields=fields, filter=filter)
+        try:
+            sync_uri = self._sync(uri=uri)
+        except Exception as e:
+            # the definition may have been deleted on Eloqua, create it again once
+            logger.debug("Cannot sync cached export definition {0}, recreating it: {1}".format(uri, e))
+            self._forget(key=key, uri=uri)
+            uri = self._get_uri(key=key, entity=entity, name=name, fields=fields, filter=filter)
+            sync_uri = self._sync(uri=uri)
+        return self._iter_sync_data(sync_uri=sync_uri, limit=limit)
+
+    def _get_uri(self, key, entity, name, fields, filter):
+        def touch(definitions):
+            definition = definitions.get(key)
+            if definition:
+                definition["used"] = time.time()
+                return definition["uri"]
+            return None
+
+        uri = self._update(touch)
+        if uri:
+            return uri
+        # EML helpers such as eml.Contact.Id render as their field statement
+        body = {"name": name, "fields": {field: str(statement) for field, statement in fields.items()}}
+        if filter:
+            body["filter"] = filter
+        response = self._session.post("{0}/{1}/exports".format(self._bulk_url, entity), json=body)
+        response.raise_for_status()
+        created_uri = response.json()["uri"]
+        logger.debug("Created export definition {0} ({1})".format(created_uri, name))
+
+        def add(definitions):
+            if key in definitions:
+                # another process registered the same shape meanwhile, keep its definition
+                definitions[key]["used"] = time.time()
+                return definitions[key]["uri"], [created_uri]
+            definitions[key] = {"uri": created_uri, "used": time.time()}
+            return created_uri, self._evict(definitions)
+
+        uri, evicted = self._update(add)
+        for evicted_uri in evicted:
+            self._delete(uri=evicted_uri)
+        return uri
+
+    def _forget(self, key, uri):
+        def remove(definitions):
+            # another process may have replaced the definition already, its new one is kept
+            if definitions.get(key, {}).get("uri") == uri:
+                del definitions[key]
+                return True
+            return False
+
+        # a definition out of the registry is never evicted, so it is deleted on Eloqua too (if it still exists)
+        if self._update(remove):
+            self._delete(uri=uri)
+
+    def _evict(self, definitions):
+        evicted = []
+        while len(definitions) > self._max_definitions:
+            key = min(definitions, key=lambda k: definitions[k]["used"])
+            evicted.append(definitions.pop(key)["uri"])
+        return evicted
+
+    def _update(self, change):
+        # apply change to the current file contents, so definitions registered by other processes are kept
+        with self._lock, self._file_lock():
+            self._definitions = self._load()
+            result = change(self._definitions)
+            self._save()
+        return result
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self._path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _delete(self, uri):
+        try:
+            self._session.delete(self._bulk_url + uri).raise_for_status()
+            logger.debug("Deleted export definition {0}".format(uri))
+        except Exception as e:
+            logger.debug("Cannot delete export definition {0}: {1}".format(uri, e))
+
+    def _sync(self, uri):
+        return run_sync(session=self._session, bulk_url=self._bulk_url, uri=uri)
+
+    def _iter_sync_data(self, sync_uri, limit):
+        offset = 0
+        while not limit or offset < limit:
+            page_size = min(sync_page_size, limit - offset) if limit else sync_page_size
+            response = self._session.get("{0}{1}/data".format(self._bulk_url, sync_uri),
+                                         params={"limit": page_size, "offset": offset})
+            response.raise_for_status()
+            page = response.json()
+            items = page.get("items", [])
+            for item in items:
+                yield item
+            offset += len(items)
+            if not page.get("hasMore") or not items:
+                break
+
+    def _load(self):
+        if self._path and os.path.exists(self._path):
+            try:
+                with open(self._path, "r") as f:
+                    return json.load(f)
+            except ValueError:
+                logger.warning("Ignoring unreadable export definition cache {0}".format(self._path))
+        return {}
+
+    def _save(self):
+        # write then rename, so concurrent processes never read a half written file
+        tmp_path = "{0}.{1}.tmp".format(self._path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self._definitions, f)
+        os.replace(tmp_path, self._path)
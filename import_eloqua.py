@@ -1,97 +1,181 @@
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import math
+from queue import Queue
 import sys
-
-from dea import BulkClient
-from dea.bulk import CdoImportDefinition, ImportDefinition
-from dea.bulk.api.cdo import BulkCdoClient
-from dea.bulk.definitions import MapDataCardsConfig
-from dea.bulk.eml import eml
-from requests.auth import HTTPBasicAuth
+from threading import Thread
+import time
 
 import config
 import settings
 from app import app
-from database import get_db
+from database import get_db, regions, content_hash
+from eloqua_session import get_bulk_importer
 from logging_config import setup_logging
-import re
 
 logger = setup_logging(__name__)
 
-es_pattern = re.compile(r"ES")
-pt_pattern = re.compile(r"PT")
-uk_pattern = re.compile(r"UK")
-de_pattern = re.compile(r"DE")
-region_labels = ["ES", "ES", "UK", "DE"]
-region_patterns = [es_pattern, pt_pattern, uk_pattern, de_pattern]
-
-
-def import_to_eloqua():
-    with app.app_context():
-        db = get_db()
-        index = 0
-        while index != len(region_labels):
-            logger.debug("Start importing to Eloqua for region {0}".format(region_labels[index]))
-            contacts = db.get_contact_data(region=region_patterns[index])
-            activities = db.get_cdo_data(collection="activity", region=region_patterns[index])
-            institutions = db.get_cdo_data(collection="institution", region=region_patterns[index])
-            # import contacts
-            if contacts:
-                filtered_data = filter_new_data(db=db, collection="contactPast",
-                                                current_data=contacts, region=region_patterns[index])
-                if filtered_data:
-                    bulk_import_contact(data=filtered_data, fields=config.contact_import_def)
-                db.move_data_past(collection="contactPast", data=filtered_data, region=region_patterns[index])
-            else:
-                logger.debug("No Contact to import to Eloqua for region {0}, country {1}".format(region_labels[index],
-                                                                                                      region_patterns[index].pattern))
-            # import activities
-            if activities:
-                filtered_data = filter_new_data(db=db, collection="activityPast",
-                                                current_data=activities, region=region_patterns[index])
-                if filtered_data:
-                    bulk_import_cdo(data=filtered_data, cdo_id=config.activity_cdo_id, fields=config.activity_import_def)
-                db.move_data_past(collection="activityPast", data=filtered_data, region=region_patterns[index])
-            else:
-                logger.debug("No Activity CDO to import to Eloqua for region {0}, country {1}".format(region_labels[index],
-                                                                                                           region_patterns[index].pattern))
-                # delete current data if same with already imported, and keep past data
-                db.delete_data(collection="activity", region=region_patterns[index])
-                db.delete_data(collection="personActivity", region=region_patterns[index])
-            # import institutions
-            if institutions:
-                filtered_data = filter_new_data(db=db, collection="institutionPast",
-                                                current_data=institutions, region=region_patterns[index])
-                if filtered_data:
-                    bulk_import_cdo(data=filtered_data, cdo_id=config.institution_cdo_id, fields=config.institution_import_def)
-                db.move_data_past(collection="institutionPast", data=filtered_data, region=region_patterns[index])
-            else:
-                logger.debug("No Institution CDO to import to Eloqua for region {0}, country {1}".format(region_labels[index],
-                                                                                                              region_patterns[index].pattern))
-                db.delete_data(collection="institution", region=region_patterns[index])
-                db.delete_data(collection="personInstitution", region=region_patterns[index])
-            logger.debug("Finish importing to Eloqua for region {0}".format(region_labels[index]))
-            # increase index
-            index += 1
+# entities imported per region by the pipeline, in import order
+pipeline_entities = {
+    "contact": {"past": "contactPast"},
+    "activity": {"past": "activityPast", "cdo_id": config.activity_cdo_id, "fields": config.activity_import_def},
+    "institution": {"past": "institutionPast", "cdo_id": config.institution_cdo_id,
+                    "fields": config.institution_import_def},
+}
+
+
+def import_to_eloqua(workers=1):
+    # regions are independent, each one is read, diffed, uploaded and archived on its own worker
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(import_region, regions))
+    for region, status, elapsed in results:
+        logger.debug("Region {0}: {1} in {2:.1f}s".format(region, status, elapsed))
+    logger.debug("Import to Eloqua finished in {0:.1f}s".format(time.monotonic() - started))
+    return results
+
+
+def import_region(region):
+    started = time.monotonic()
+    # a failing region is logged and reported without stopping the other ones
+    try:
+        with app.app_context():
+            import_region_data(db=get_db(), region=region)
+        status = "success"
+    except Exception:
+        logger.exception("Importing to Eloqua failed for region {0}".format(region))
+        status = "error"
+    return region, status, time.monotonic() - started
+
+
+def import_region_data(db, region):
+    # the same stages as the pipeline, run one after the other; a failing stage fails the whole region
+    logger.debug("Start importing to Eloqua for region {0}".format(region))
+    for entity in pipeline_entities:
+        job = new_import_job(region=region, entity=entity)
+        for stage in pipeline_stages:
+            if job["skip"]:
+                break
+            stage(db=db, job=job)
+    logger.debug("Finish importing to Eloqua for region {0}".format(region))
+
+
+def new_import_job(region, entity):
+    return {"region": region, "entity": entity, "status": "success", "skip": False, "timings": {}}
+
+
+def import_to_eloqua_pipeline(queue_size=2):
+    # read, diff, upload and archive run on their own threads connected by bounded queues,
+    # so the next region/entity is read and diffed from Mongo while the previous one uploads to Eloqua
+    started = time.monotonic()
+    queues = [Queue(maxsize=queue_size) for _ in pipeline_stages]
+    results = []
+    threads = [Thread(target=run_pipeline_stage, name=stage.__name__,
+                      args=(stage, queues[position], queues[position + 1] if position + 1 < len(queues) else None,
+                            results))
+               for position, stage in enumerate(pipeline_stages)]
+    for thread in threads:
+        thread.start()
+    for region in regions:
+        for entity in pipeline_entities:
+            queues[0].put(new_import_job(region=region, entity=entity))
+    queues[0].put(None)
+    for thread in threads:
+        thread.join()
+    for job in results:
+        logger.debug("Region {0} {1}: {2} ({3})".format(
+            job["region"], job["entity"], job["status"],
+            ", ".join("{0} {1:.1f}s".format(stage, elapsed) for stage, elapsed in job["timings"].items())))
+    logger.debug("Import to Eloqua finished in {0:.1f}s".format(time.monotonic() - started))
+    return [("{0} {1}".format(job["region"], job["entity"]), job["status"], sum(job["timings"].values()))
+            for job in results]
+
+
+def run_pipeline_stage(stage, inbox, outbox, results):
+    def forward(job):
+        if outbox is not None:
+            outbox.put(job)
+        else:
+            results.append(job)
+
+    job = None
+    try:
+        with app.app_context():
+            db = get_db()
+            while True:
+                job = inbox.get()
+                if job is None:
+                    return
+                # a failed job passes through the remaining stages untouched, so its current data is not archived
+                if job["status"] == "success" and not job["skip"]:
+                    started = time.monotonic()
+                    try:
+                        stage(db=db, job=job)
+                    except Exception:
+                        logger.exception("{0} failed for {1} of region {2}".format(stage.__name__, job["entity"],
+                                                                                   job["region"]))
+                        job["status"] = "error"
+                    job["timings"][stage.__name__] = time.monotonic() - started
+                forward(job)
+                job = None
+    except Exception:
+        # the stage itself broke down, e.g. no database: every job still queued fails instead of waiting forever
+        logger.exception("{0} stopped, failing the remaining jobs".format(stage.__name__))
+        if job is None:
+            job = inbox.get()
+        while job is not None:
+            job["status"] = "error"
+            forward(job)
+            job = inbox.get()
+    finally:
+        # the sentinel always reaches the next stage, so every thread ends and the run reports its failures
+        if outbox is not None:
+            outbox.put(None)
+
+
+def read_stage(db, job):
+    if job["entity"] == "contact":
+        job["data"] = db.get_contact_data(region=job["region"])
+        if not job["data"]:
+            logger.debug("No Contact to import to Eloqua for region {0}".format(job["region"]))
+            job["skip"] = True
+    else:
+        job["data"] = list(db.get_cdo_data(collection=job["entity"], region=job["region"]))
+
+
+def diff_stage(db, job):
+    job["data"] = filter_new_data(db=db, collection=pipeline_entities[job["entity"]]["past"],
+                                  current_data=job["data"], region=job["region"])
+
+
+def upload_stage(db, job):
+    if not job["data"]:
+        logger.debug("No {0} to import to Eloqua for region {1}".format(job["entity"], job["region"]))
+    elif job["entity"] == "contact":
+        bulk_import_contact_changes(db=db, data=job["data"], region=job["region"])
+    else:
+        entity = pipeline_entities[job["entity"]]
+        bulk_import_cdo(data=job["data"], cdo_id=entity["cdo_id"], fields=entity["fields"])
+
+
+def archive_stage(db, job):
+    db.move_data_past(collection=pipeline_entities[job["entity"]]["past"], data=job["data"], region=job["region"])
+
+
+pipeline_stages = (read_stage, diff_stage, upload_stage, archive_stage)
 
 
 def bulk_import_cdo(data, cdo_id, fields):
-    dea_client = BulkCdoClient(auth=HTTPBasicAuth(username=settings.ELQ_USER, password=settings.ELQ_PASSWORD),
-                               base_url=settings.ELQ_BASE_URL)
     # define different import def name
     import_def_name = "activity_cdo_import_def"
     if cdo_id == config.institution_cdo_id:
         import_def_name = "institution_cdo_import_def"
     # map to field IM CRM Contact ID
-    map_data_card = MapDataCardsConfig(entity_type="Contact", entity_field=eml.Contact.Field("C_IM_CRM_Contact_ID1"),
-                                       source_field="IM_CRM_Contact_ID")
-    cdo_import_def = CdoImportDefinition(name=import_def_name, fields=fields,
-                                         id_field_name="IM_CRM_Row_ID",
-                                         parent_id=cdo_id,
-                                         trigger_sync_on_import=True,
-                                         map_data_cards=map_data_card)
-    with dea_client.bulk_cdo.imports.create_import(import_def=cdo_import_def, parent_id=cdo_id) as bulk_import:
-        bulk_import.add_items(data)
-        bulk_import.upload_and_flush_data(sync_on_upload=True)
+    map_data_card = {"entity_type": "Contact", "entity_field": "{{Contact.Field(C_IM_CRM_Contact_ID1)}}",
+                     "source_field": "IM_CRM_Contact_ID"}
+    get_bulk_importer().import_cdo(data=data, cdo_id=cdo_id, name=import_def_name, fields=fields,
+                                   id_field_name="IM_CRM_Row_ID", map_data_cards=map_data_card)
     logger.debug("Bulk CDO import complete")
     if import_def_name == "activity_cdo_import_def":
         logger.debug("{0} Activity CDO imported to Eloqua".format(len(data)))
@@ -100,34 +184,83 @@ def bulk_import_cdo(data, cdo_id, fields):
 
 
 def bulk_import_contact(data, fields):
-    dea_client = BulkClient(auth=HTTPBasicAuth(username=settings.ELQ_USER, password=settings.ELQ_PASSWORD),
-                            base_url=settings.ELQ_BASE_URL)
-    contact_import_def = ImportDefinition(name="contact_import_def", fields=fields,
-                                          id_field_name="C_EmailAddress")
-    with dea_client.bulk_contacts.imports.create_import(import_def=contact_import_def) as bulk_import:
-        bulk_import.add_items(data)
-        bulk_import.upload_and_flush_data(sync_on_upload=True)
+    get_bulk_importer().import_contacts(data=data, name="contact_import_def", fields=fields,
+                                        id_field_name="C_EmailAddress")
     logger.debug("Bulk Contact import complete")
     logger.debug("{0} Contact imported to Eloqua".format(len(data)))
 
 
+def bulk_import_contact_changes(db, data, region):
+    # only the changed fields of known contacts are sent, one narrower import per set of changed fields
+    if not settings.ELQ_CONTACT_DELTA_MAX_GROUPS:
+        bulk_import_contact(data=data, fields=config.contact_import_def)
+        return
+    past_contacts = db.get_past_contacts(region=region, emails=(contact.get("C_EmailAddress") for contact in data))
+    groups = group_contact_changes(contacts=data, past_contacts=past_contacts,
+                                   max_groups=settings.ELQ_CONTACT_DELTA_MAX_GROUPS)
+    for changed_fields, contacts in groups.items():
+        fields = {field: statement for field, statement in config.contact_import_def.items()
+                  if field in changed_fields}
+        logger.debug("Importing {0} contacts with {1} changed fields".format(len(contacts), len(fields)))
+        if len(fields) < len(config.contact_import_def):
+            # absent fields stay absent, an explicit null would blank them in Eloqua
+            contacts = [{field: contact[field] for field in fields if field in contact} for contact in contacts]
+        bulk_import_contact(data=contacts, fields=fields)
+
+
+def group_contact_changes(contacts, past_contacts, max_groups):
+    groups = defaultdict(list)
+    for contact in contacts:
+        past = past_contacts.get(contact.get("C_EmailAddress"))
+        if past is None:
+            # new contacts are sent with all fields
+            changed_fields = frozenset(config.contact_import_def)
+        else:
+            # a field missing from the current row is not sent, so it cannot have changed
+            changed_fields = frozenset(field for field in config.contact_import_def
+                                       if field in contact and contact[field] != past.get(field))
+            if not changed_fields:
+                # only fields outside the import definition changed
+                continue
+        # the email address identifies the contact in every import
+        groups[changed_fields | {"C_EmailAddress"}].append(contact)
+    if len(groups) > max_groups:
+        # the smallest groups share one import with the union of their fields
+        ordered = sorted(groups.items(), key=lambda group: len(group[1]), reverse=True)
+        kept, merged = dict(ordered[:max_groups - 1]), ordered[max_groups - 1:]
+        merged_fields = frozenset().union(*(fields for fields, _ in merged))
+        kept.setdefault(merged_fields, [])
+        for _, group_contacts in merged:
+            kept[merged_fields].extend(group_contacts)
+        return kept
+    return groups
+
+
 def filter_new_data(db, collection, current_data, region):
-    # get past data
-    past_data = []
-    if collection == "contactPast":
-        past_data = db.get_past_data(collection="contactPast", region=region)
-    if collection == "activityPast":
-        past_data = db.get_past_data(collection="activityPast", region=region)
-    if collection == "institutionPast":
-        past_data = db.get_past_data(collection="institutionPast", region=region)
-    if past_data:
+    # get content hashes of past data
+    past_hashes = db.get_past_hashes(collection=collection, region=region)
+    if past_hashes:
         # compare to get new data (different from past) only
-        filtered_data = [item for item in current_data if item not in past_data]
+        filtered_data = [item for item in current_data if content_hash(item) not in past_hashes]
         logger.debug("Filter new data vs. collection {0} complete with {1} new data compared to yesterday".format(collection, len(filtered_data)))
         return filtered_data
     logger.debug("Filter new data complete with all new data compared to {0} collection".format(collection))
-    return current_data
+    return list(current_data)
 
 
 if __name__ == '__main__':
-    import_to_eloqua()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, help="number of regions imported at once, default is {0}".format(
+        settings.ELQ_IMPORT_WORKERS), default=settings.ELQ_IMPORT_WORKERS)
+    parser.add_argument("--pipeline", type=int,
+                        help="input 1 to overlap reads, diffs, uploads and archives across regions, default is 0",
+                        default=0)
+    parser.add_argument("--queue_size", type=int, help="jobs waiting between two pipeline stages, default is {0}".format(
+        settings.ELQ_IMPORT_PIPELINE_QUEUE_SIZE), default=settings.ELQ_IMPORT_PIPELINE_QUEUE_SIZE)
+    args = parser.parse_args()
+    if args.pipeline:
+        results = import_to_eloqua_pipeline(queue_size=args.queue_size)
+    else:
+        results = import_to_eloqua(workers=args.workers)
+    if any(status != "success" for _, status, _ in results):
+        sys.exit(1)
@@ -0,0 +1,48 @@
+import settings
+from app import app
+from database import get_db
+from logging_config import setup_logging
+
+import argparse
+
+logger = setup_logging(__name__)
+
+
+def migrate_db(ensure_indexes, backfill_region, deduplicate_activities, partition_activities, apply_retention,
+               recompute_region=0):
+    with app.app_context():
+        db = get_db()
+        # must run before the unique activity index can be created on an existing collection
+        if deduplicate_activities:
+            db.deduplicate_activities()
+        # one-off: move the unpartitioned allActivities collection into monthly partitions
+        if partition_activities:
+            db.partition_activities()
+        if ensure_indexes:
+            db.ensure_indexes()
+        # one-off: derive the region field of documents stored before it existed, or of all of them again
+        # with --recompute_region after the region rules changed
+        if backfill_region or recompute_region:
+            db.backfill_region(recompute=bool(recompute_region))
+        if apply_retention:
+            db.apply_activity_retention(months=settings.ACTIVITY_RETENTION_MONTHS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ensure_indexes", type=int, help="input 1 to create missing indexes, default is 1", default=1)
+    parser.add_argument("--backfill_region", type=int, help="input 1 to backfill the region field, default is 0",
+                        default=0)
+    parser.add_argument("--recompute_region", type=int,
+                        help="input 1 to derive the region field of all documents again, default is 0", default=0)
+    parser.add_argument("--deduplicate_activities", type=int,
+                        help="input 1 to delete duplicated activities, default is 0", default=0)
+    parser.add_argument("--partition_activities", type=int,
+                        help="input 1 to move allActivities into monthly partitions, default is 0", default=0)
+    parser.add_argument("--apply_retention", type=int,
+                        help="input 1 to drop activity partitions older than ACTIVITY_RETENTION_MONTHS, default is 0",
+                        default=0)
+    args = parser.parse_args()
+    migrate_db(ensure_indexes=args.ensure_indexes, backfill_region=args.backfill_region,
+               deduplicate_activities=args.deduplicate_activities, partition_activities=args.partition_activities,
+               apply_retention=args.apply_retention, recompute_region=args.recompute_region)
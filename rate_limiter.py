@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+# responses telling us to slow down, their Retry-After pauses every caller of the governor
+throttled_status = (429, 503)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RateGovernor:
+    def __init__(self, rate, burst, max_concurrent):
+        # token bucket refilled with rate tokens per second up to burst, plus a cap on calls in flight
+        self.rate = float(rate)
+        self.burst = max(int(burst), 1)
+        self.max_concurrent = max(int(max_concurrent), 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._waiting = 0
+        self._calls = 0
+        self._throttled = 0
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        else:
+            self._tokens = float(self.burst)
+        self._updated = now
+
+    def _wait_time(self, now):
+        # seconds until a slot and a token are both available, None when a slot is missing
+        if self._in_flight >= self.max_concurrent:
+            return None
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        return 0
+
+    @contextmanager
+    def acquire(self):
+        with self._condition:
+            self._waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._wait_time(now)
+                    if wait == 0:
+                        break
+                    self._condition.wait(wait)
+            finally:
+                self._waiting -= 1
+            self._tokens -= 1
+            self._in_flight += 1
+            self._calls += 1
+        try:
+            yield self
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def pause(self, seconds):
+        if not seconds:
+            return
+        with self._condition:
+            self._throttled += 1
+            paused_until = time.monotonic() + seconds
+            if paused_until > self._paused_until:
+                self._paused_until = paused_until
+                logger.warning("Eloqua throttled the client, pausing calls for {0:.1f} seconds".format(seconds))
+            self._condition.notify_all()
+
+    def utilisation(self):
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            return {"inFlight": self._in_flight,
+                    "maxConcurrent": self.max_concurrent,
+                    "concurrency": self._in_flight / self.max_concurrent,
+                    "waiting": self._waiting,
+                    "tokens": round(self._tokens, 2),
+                    "burst": self.burst,
+                    "ratePerSecond": self.rate,
+                    "pausedForSeconds": round(max(self._paused_until - now, 0.0), 2),
+                    "calls": self._calls,
+                    "throttled": self._throttled}
+
+
+class GovernedRetry(Retry):
+    # urllib3 retry that also pauses the governor on throttled responses, so the other callers back off too
+    governor = None
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.governor = self.governor
+        return retry
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # POST creates definitions, syncs and imports: a 5xx may come after Eloqua acted and a retry would
+        # duplicate it, only a 429 rejection is safe to send again
+        if not self._is_method_retryable(method):
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, *args, **kwargs):
+        if self.governor is not None and response is not None and response.status in throttled_status:
+            self.governor.pause(parse_retry_after(response.headers.get("Retry-After")))
+        return super().increment(method, url, response, *args, **kwargs)
+
+
+class GovernedAdapter(HTTPAdapter):
+    def __init__(self, governor, *args, **kwargs):
+        self.governor = governor
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        with self.governor.acquire():
+            return super().send(request, **kwargs)
@@ -10,3 +10,61 @@ ELQ_BASE_URL = env("ELQ_BASE_URL")
 CLOUD_APP_DB_NAME = "eloqua-app-db"
 DB_USER = env("DB_USER")
 DB_PASSWORD = env("DB_PASSWORD")
+
+# MongoDB connection pool shared by the app and the CLI scripts
+MONGO_URI = env("MONGO_URI", "mongodb://localhost:27017")
+MONGO_MAX_POOL_SIZE = env.int("MONGO_MAX_POOL_SIZE", 100)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = env.int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = env.int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000)
+# number of activities written per bulk_write by export_db.py
+ACTIVITY_UPSERT_BATCH_SIZE = env.int("ACTIVITY_UPSERT_BATCH_SIZE", 1000)
+# activities created this long before the last synced one are exported again
+ACTIVITY_SYNC_OVERLAP_HOURS = env.int("ACTIVITY_SYNC_OVERLAP_HOURS", 24)
+# number of activity type exports run concurrently by export_db.py
+ELQ_EXPORT_WORKERS = env.int("ELQ_EXPORT_WORKERS", 1)
+# contacts per PageView export filter, bounded by the length Eloqua accepts for a filter
+ELQ_PAGE_VIEW_CONTACT_CHUNK_SIZE = env.int("ELQ_PAGE_VIEW_CONTACT_CHUNK_SIZE", 50)
+# date range splitting of activity exports so no window exceeds the 50,000 rows sync limit:
+# start of history for types without a watermark,
+# initial window size and number of windows exported concurrently per activity type
+ELQ_EXPORT_HISTORY_START = env("ELQ_EXPORT_HISTORY_START", "2000-01-01")
+ELQ_EXPORT_WINDOW_DAYS = env.int("ELQ_EXPORT_WINDOW_DAYS", 30)
+ELQ_EXPORT_WINDOW_WORKERS = env.int("ELQ_EXPORT_WINDOW_WORKERS", 1)
+# local file keeping the URIs of reusable Eloqua export definitions (empty disables reuse)
+ELQ_EXPORT_DEF_CACHE_PATH = env("ELQ_EXPORT_DEF_CACHE_PATH", "export_definitions.json")
+ELQ_EXPORT_DEF_CACHE_SIZE = env.int("ELQ_EXPORT_DEF_CACHE_SIZE", 100)
+# cache of GET /contact export results, keyed by label, dateFrom and dateTo;
+# set CONTACT_CACHE_DIR to share the entries between worker processes
+CONTACT_CACHE_TTL_SECONDS = env.int("CONTACT_CACHE_TTL_SECONDS", 900)
+CONTACT_CACHE_SIZE = env.int("CONTACT_CACHE_SIZE", 32)
+CONTACT_CACHE_DIR = env("CONTACT_CACHE_DIR", "")
+# background workers running POST /contact/exports jobs
+CONTACT_EXPORT_WORKERS = env.int("CONTACT_EXPORT_WORKERS", 2)
+# a pending or running export job whose worker process has not refreshed its heartbeat for this long is
+# reported as failed, e.g. after a restart; the worker refreshes it every third of this, 0 never fails a job
+CONTACT_EXPORT_STALE_SECONDS = env.int("CONTACT_EXPORT_STALE_SECONDS", 300)
+# contact reads over at most ELQ_REST_MAX_DAYS matching at most ELQ_REST_MAX_ROWS contacts
+# use the REST API instead of a bulk export (0 always uses bulk)
+ELQ_REST_MAX_ROWS = env.int("ELQ_REST_MAX_ROWS", 1000)
+ELQ_REST_MAX_DAYS = env.int("ELQ_REST_MAX_DAYS", 7)
+# pooled HTTP session shared by all Eloqua calls of a process, retried with backoff on 429/5xx
+ELQ_HTTP_POOL_SIZE = env.int("ELQ_HTTP_POOL_SIZE", 10)
+ELQ_HTTP_RETRIES = env.int("ELQ_HTTP_RETRIES", 5)
+ELQ_HTTP_BACKOFF_FACTOR = env.float("ELQ_HTTP_BACKOFF_FACTOR", 1.0)
+# limits of the Eloqua call governor: calls per second with bursts, and calls/syncs in flight at once
+ELQ_RATE_LIMIT_PER_SECOND = env.float("ELQ_RATE_LIMIT_PER_SECOND", 8.0)
+ELQ_RATE_LIMIT_BURST = env.int("ELQ_RATE_LIMIT_BURST", 16)
+ELQ_MAX_CONCURRENT_CALLS = env.int("ELQ_MAX_CONCURRENT_CALLS", 10)
+# regions imported to Eloqua at once by import_eloqua
+ELQ_IMPORT_WORKERS = env.int("ELQ_IMPORT_WORKERS", 1)
+# bulk imports are uploaded in batches, several at once, and synced at the end or every N batches (0 = once)
+ELQ_IMPORT_BATCH_SIZE = env.int("ELQ_IMPORT_BATCH_SIZE", 5000)
+ELQ_IMPORT_BATCH_WORKERS = env.int("ELQ_IMPORT_BATCH_WORKERS", 4)
+ELQ_IMPORT_SYNC_EVERY_BATCHES = env.int("ELQ_IMPORT_SYNC_EVERY_BATCHES", 0)
+ELQ_IMPORT_BATCH_RETRIES = env.int("ELQ_IMPORT_BATCH_RETRIES", 3)
+# jobs buffered between two stages of the import_eloqua --pipeline mode
+ELQ_IMPORT_PIPELINE_QUEUE_SIZE = env.int("ELQ_IMPORT_PIPELINE_QUEUE_SIZE", 2)
+# contacts are imported with only their changed fields, in at most this many imports (0 sends full rows)
+ELQ_CONTACT_DELTA_MAX_GROUPS = env.int("ELQ_CONTACT_DELTA_MAX_GROUPS", 5)
+# months of allActivities partitions kept by export_db and migrate_db --apply_retention (0 keeps everything)
+ACTIVITY_RETENTION_MONTHS = env.int("ACTIVITY_RETENTION_MONTHS", 0)
@@ -0,0 +1,42 @@
+import os
+import sys
+
+from flask import Flask
+import pytest
+
+# the modules read logging.json and write logs/ relative to the repository root
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.chdir(root)
+os.makedirs("logs", exist_ok=True)
+# required by settings.py, the tests never call Eloqua or the configured database
+for name in ("ELQ_USER", "ELQ_PASSWORD", "ELQ_BASE_URL", "DB_USER", "DB_PASSWORD"):
+    os.environ.setdefault(name, "https://eloqua.test" if name == "ELQ_BASE_URL" else "test")
+
+test_db_name = "eloqua-app-db-test"
+
+
+@pytest.fixture
+def mongo_client():
+    # tests needing MongoDB run against MONGO_TEST_URI and are skipped when no mongod answers
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+    client = MongoClient(os.environ.get("MONGO_TEST_URI", "mongodb://localhost:27017"),
+                         serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip("no mongod available")
+    client.drop_database(test_db_name)
+    yield client
+    client.drop_database(test_db_name)
+    client.close()
+
+
+@pytest.fixture
+def db(mongo_client):
+    from database import Database
+    app = Flask(__name__)
+    app.config["CLOUD_APP_DB_NAME"] = test_db_name
+    with app.app_context():
+        yield Database(client=mongo_client)
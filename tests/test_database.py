@@ -0,0 +1,105 @@
+from database import activity_sort, build_activity_query, decode_page_token, encode_page_token, indexes
+
+
+def test_build_activity_query_range_and_region():
+    query = build_activity_query(date_field="ActivityDate", date_from="2021-01-01", date_to="2021-02-01",
+                                 region="ES")
+    assert query == {"ActivityDate": {"$gt": "2021-01-01", "$lt": "2021-02-01"}, "region": "ES"}
+
+
+def test_build_activity_query_open_range():
+    assert build_activity_query(date_field="C_DateModified", date_from="2021-01-01") == \
+        {"C_DateModified": {"$gt": "2021-01-01"}}
+    assert build_activity_query(date_field="ActivityDate", region="UK") == {"region": "UK"}
+
+
+def test_build_activity_query_without_filters():
+    assert build_activity_query() == {}
+
+
+def winning_stages(plan):
+    stages = [plan["stage"]]
+    for child in plan.get("inputStages", []) + ([plan["inputStage"]] if "inputStage" in plan else []):
+        stages += winning_stages(child)
+    return stages
+
+
+def test_activity_queries_use_an_index(mongo_client):
+    collection = mongo_client["eloqua-app-db-test"]["allActivities_202101"]
+    for keys, options in indexes["allActivities"]:
+        collection.create_index(keys, **options)
+    collection.insert_many([{"ActivityType": "EmailOpen", "ActivityId": i, "region": ["ES", "UK"][i % 2],
+                             "ActivityDate": "2021-01-{0:02d} 10:00:00".format(i % 28 + 1),
+                             "C_DateModified": "2021-01-{0:02d} 12:00:00".format(i % 28 + 1)}
+                            for i in range(200)])
+    queries = [build_activity_query(date_field="ActivityDate", date_from="2021-01-05", date_to="2021-01-10",
+                                    region="ES"),
+               build_activity_query(date_field="ActivityDate", date_from="2021-01-05"),
+               build_activity_query(date_field="C_DateModified", date_from="2021-01-05", region="UK")]
+    for query in queries:
+        plan = collection.find(query).sort(activity_sort).explain()["queryPlanner"]["winningPlan"]
+        stages = winning_stages(plan)
+        assert "IXSCAN" in stages, (query, stages)
+        assert "COLLSCAN" not in stages, (query, stages)
+
+
+def test_page_token_round_trip():
+    token = encode_page_token({"ActivityDate": "2021-01-05 10:00:00", "ActivityId": 42, "ActivityType": "EmailOpen"})
+    assert decode_page_token(token) == ("2021-01-05 10:00:00", 42)
+    assert decode_page_token(encode_page_token({"ActivityId": 7})) == (None, 7)
+
+
+def test_invalid_page_token():
+    for token in ("not a token", "", encode_page_token({})[:-3] + "!!!"):
+        assert decode_page_token(token) is None
+
+
+def test_keyset_pages_cover_every_activity(db):
+    dates = [None, None, "2021-01-05 10:00:00", "2021-01-05 10:00:00", "2021-02-01 00:00:00", "2021-03-15 09:00:00"]
+    db.upsert_activities(data=[{"ActivityType": "EmailOpen", "ActivityId": activity_id, "ActivityDate": date,
+                                "C_IM_CRM_Contact_ID1": "ES-1"} for activity_id, date in enumerate(dates)],
+                         batch_size=100)
+    seen = []
+    after = None
+    while True:
+        page = list(db.query_all_activities_data(activity_date_from="", activity_date_to="", region="",
+                                                 limit=2, after=after))
+        if not page:
+            break
+        seen += [activity["ActivityId"] for activity in page]
+        after = decode_page_token(encode_page_token(page[-1]))
+    assert seen == list(range(len(dates)))
+    offset_page = list(db.query_all_activities_data(activity_date_from="", activity_date_to="", region="",
+                                                    limit=2, offset=3))
+    assert [activity["ActivityId"] for activity in offset_page] == [3, 4]
+
+
+def test_deduplicated_partitions_get_the_unique_index(db, mongo_client):
+    partition = mongo_client["eloqua-app-db-test"]["allActivities_202101"]
+    partition.insert_many([{"ActivityType": "EmailOpen", "ActivityId": 1, "ActivityDate": "2021-01-05 10:00:00"}
+                           for _ in range(3)])
+    db.deduplicate_activities()
+    db.ensure_indexes()
+    assert partition.count_documents({}) == 1
+    assert any(index.get("unique") for index in partition.index_information().values())
+
+
+def test_export_jobs_without_a_heartbeat_are_failed(db, mongo_client):
+    from datetime import datetime, timedelta
+    jobs = mongo_client["eloqua-app-db-test"]["contactExportJobs"]
+    live_job = db.create_export_job(region="ES", date_from="", date_to="")
+    stale_job = db.create_export_job(region="UK", date_from="", date_to="")
+    jobs.update_many({}, {"$set": {"status": "running"}})
+    jobs.update_one({"label": "UK"}, {"$set": {"heartbeatAt": datetime.utcnow() - timedelta(minutes=10)}})
+    assert db.get_export_job(live_job, stale_after=300)["status"] == "running"
+    assert db.get_export_job(stale_job, stale_after=0)["status"] == "running"
+    assert db.get_export_job(stale_job, stale_after=300)["status"] == "error"
+
+
+def test_archived_contacts_hold_only_the_latest_version(db):
+    db.move_data_past(collection="contactPast", region="ES",
+                      data=[{"C_EmailAddress": "a@test", "C_FirstName": "Ann", "C_Title": "Dr"}])
+    db.move_data_past(collection="contactPast", region="ES",
+                      data=[{"C_EmailAddress": "a@test", "C_FirstName": "Anna"}])
+    assert db.get_past_contacts(region="ES", emails=["a@test"]) == {
+        "a@test": {"C_EmailAddress": "a@test", "C_FirstName": "Anna"}}
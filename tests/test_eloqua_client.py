@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+import re
+
+import eloqua_client
+from eloqua_client import ElqClient, eloqua_date_format
+
+
+def fake_export(timestamps):
+    # an _export replacement returning the rows created inside the filter's window, cut at sync_limit
+    def export(entity, name, fields, filter, reuse=False):
+        window_from, window_to = [datetime.strptime(value, eloqua_date_format)
+                                  for value in re.findall(r"'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)'", filter)]
+        rows = [{"ActivityId": index, "ActivityDate": timestamp.strftime(eloqua_date_format)}
+                for index, timestamp in enumerate(timestamps) if window_from <= timestamp < window_to]
+        return rows[:eloqua_client.sync_limit]
+    return export
+
+
+def export_windowed(client, date_from, date_to, **kwargs):
+    return client.export_windowed(entity="activities", name="test", fields={}, filter="'a'='b'",
+                                  date_field="{{Activity.CreatedAt}}", date_from=date_from, date_to=date_to,
+                                  **kwargs)
+
+
+def test_export_windowed_splits_windows_over_the_sync_limit(monkeypatch):
+    monkeypatch.setattr(eloqua_client, "sync_limit", 10)
+    start = datetime(2021, 1, 1)
+    # a quiet month followed by a burst of 95 activities within one day
+    timestamps = [start + timedelta(days=day) for day in range(0, 30, 3)] + \
+                 [start + timedelta(days=40, minutes=minute * 7) for minute in range(95)]
+    client = ElqClient(username="user", password="password", base_url="https://eloqua.test")
+    monkeypatch.setattr(client, "_export", fake_export(timestamps))
+    for workers in (1, 3):
+        rows, complete = export_windowed(client, start, start + timedelta(days=60), window=timedelta(days=30),
+                                         max_workers=workers)
+        assert complete
+        assert sorted(row["ActivityId"] for row in rows) == list(range(len(timestamps)))
+
+
+def test_export_windowed_reports_truncated_windows(monkeypatch):
+    monkeypatch.setattr(eloqua_client, "sync_limit", 10)
+    start = datetime(2021, 1, 1)
+    # more activities in the same second than one sync can return
+    timestamps = [start + timedelta(hours=1)] * 15
+    client = ElqClient(username="user", password="password", base_url="https://eloqua.test")
+    monkeypatch.setattr(client, "_export", fake_export(timestamps))
+    rows, complete = export_windowed(client, start, start + timedelta(days=1), window=timedelta(days=1))
+    assert not complete
+    assert len(rows) == 10
+
+
+def test_full_exports_are_redone_in_windows(monkeypatch):
+    monkeypatch.setattr(eloqua_client, "sync_limit", 10)
+    start = datetime(2021, 1, 1)
+    timestamps = [start + timedelta(hours=hour) for hour in range(25)]
+    windowed = fake_export(timestamps)
+    calls = []
+
+    def export(entity, name, fields, filter, reuse=False):
+        calls.append(reuse)
+        if filter == "'a'='b'":
+            # the unwindowed export is cut at the sync limit
+            return [{"ActivityId": index} for index in range(eloqua_client.sync_limit)]
+        return windowed(entity, name, fields, filter, reuse)
+
+    client = ElqClient(username="user", password="password", base_url="https://eloqua.test")
+    monkeypatch.setattr(client, "_export", export)
+    rows = client._export_all(entity="contacts", name="test", fields={}, filter="'a'='b'",
+                              date_field="{{Contact.Field(C_DateModified)}}", date_from="2021-01-01",
+                              date_to="2021-01-03", reuse=True)
+    assert sorted(row["ActivityId"] for row in rows) == list(range(len(timestamps)))
+    # only the first, unwindowed export may reuse a cached definition
+    assert calls[0] and not any(calls[1:])
+
+
+def test_page_views_are_exported_per_chunk_of_contact_ids(monkeypatch):
+    client = ElqClient(username="user", password="password", base_url="https://eloqua.test")
+    contacts = [{"id": str(index)} for index in range(120)] + [{"id": None}, {}]
+    chunks = []
+    monkeypatch.setattr(client, "export_contact_with_crm_id", lambda first_run: contacts)
+    monkeypatch.setattr(client, "_export_page_view_for_contacts", lambda contact_ids: chunks.append(contact_ids) or [])
+    monkeypatch.setattr(client, "_export_all", lambda **kwargs: [])
+    assert client.export_page_view_with_contact(first_run=False) == ([], 0)
+    assert [len(chunk) for chunk in chunks] == [50, 50, 20]
+    assert None not in sum(chunks, [])
@@ -0,0 +1,84 @@
+from threading import Thread
+
+import config
+import import_eloqua
+from import_eloqua import group_contact_changes, import_region_data, import_to_eloqua_pipeline
+
+
+def contact(email, **fields):
+    row = {field: "" for field in config.contact_import_def}
+    row.update(C_EmailAddress=email, **fields)
+    return row
+
+
+def test_contacts_are_grouped_by_changed_fields():
+    past = {"a@test": contact("a@test", C_Firstname="Ann"),
+            "b@test": contact("b@test", C_Firstname="Bob"),
+            "c@test": contact("c@test", C_Title="Dr")}
+    contacts = [contact("a@test", C_Firstname="Anna"),
+                contact("b@test", C_Firstname="Bobby"),
+                contact("c@test", C_Title="Prof", C_Company="IM"),
+                contact("d@test")]
+    groups = group_contact_changes(contacts=contacts, past_contacts=past, max_groups=5)
+    assert {fields: [row["C_EmailAddress"] for row in rows] for fields, rows in groups.items()} == {
+        frozenset({"C_EmailAddress", "C_Firstname"}): ["a@test", "b@test"],
+        frozenset({"C_EmailAddress", "C_Title", "C_Company"}): ["c@test"],
+        # new contacts are sent with every field
+        frozenset(config.contact_import_def): ["d@test"],
+    }
+
+
+def test_contacts_changed_outside_the_import_definition_are_skipped():
+    past = {"a@test": contact("a@test")}
+    assert group_contact_changes(contacts=[dict(contact("a@test"), NotImported="x")], past_contacts=past,
+                                 max_groups=5) == {}
+
+
+def test_smallest_groups_are_merged_over_the_limit():
+    past = {email: contact(email) for email in ("a@test", "b@test", "c@test", "d@test")}
+    contacts = [contact("a@test", C_Firstname="A"), contact("b@test", C_Firstname="B"),
+                contact("c@test", C_Title="C"), contact("d@test", C_Company="D")]
+    groups = group_contact_changes(contacts=contacts, past_contacts=past, max_groups=2)
+    assert len(groups) == 2
+    assert [row["C_EmailAddress"] for row in groups[frozenset({"C_EmailAddress", "C_Firstname"})]] == \
+        ["a@test", "b@test"]
+    assert sorted(row["C_EmailAddress"] for row in groups[frozenset({"C_EmailAddress", "C_Title", "C_Company"})]) == \
+        ["c@test", "d@test"]
+
+
+def test_region_import_runs_the_pipeline_stages_in_order(monkeypatch):
+    calls = []
+
+    def read_stage(db, job):
+        calls.append(("read", job["entity"]))
+        job["skip"] = job["entity"] == "contact"
+
+    def upload_stage(db, job):
+        calls.append(("upload", job["entity"]))
+
+    monkeypatch.setattr(import_eloqua, "pipeline_stages", (read_stage, upload_stage))
+    import_region_data(db=None, region="EU")
+    # a skipped job stops before its remaining stages
+    assert calls == [("read", "contact"), ("read", "activity"), ("upload", "activity"),
+                     ("read", "institution"), ("upload", "institution")]
+
+
+def test_pipeline_fails_every_job_when_a_stage_cannot_start(monkeypatch):
+    def broken_db():
+        raise RuntimeError("no database")
+
+    monkeypatch.setattr(import_eloqua, "get_db", broken_db)
+    results = []
+    run = Thread(target=lambda: results.extend(import_to_eloqua_pipeline(queue_size=1)), daemon=True)
+    run.start()
+    run.join(timeout=10)
+    assert not run.is_alive()
+    assert len(results) == len(import_eloqua.regions) * len(import_eloqua.pipeline_entities)
+    assert {status for _, status, _ in results} == {"error"}
+
+
+def test_fields_missing_from_the_current_contact_are_not_changes():
+    past = {"a@test": contact("a@test", C_Firstname="Ann", C_Title="Dr")}
+    current = {"C_EmailAddress": "a@test", "C_Firstname": "Anna"}
+    groups = group_contact_changes(contacts=[current], past_contacts=past, max_groups=5)
+    assert list(groups) == [frozenset({"C_EmailAddress", "C_Firstname"})]